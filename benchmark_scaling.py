@@ -0,0 +1,272 @@
+#!/home/jkploudre/miniconda3/bin/python3
+
+import datetime as datetime
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# Size of the 1x network. Each dimension is scaled on its own, so a curve
+# shows how the build grows with that dimension alone.
+base_size = {"clinics": 10, "providers": 8, "metrics": 15, "weeks": 52}
+scales = [1, 10]
+dimensions = ["providers", "clinics", "metrics", "weeks"]
+
+# Stages run by benchmark builds. SVGs need vl-convert or Selenium, and PDFs
+# a WeasyPrint that loads, so stages this machine can't run are skipped.
+benchmark_stages = ["charts", "svgs", "html", "pdf", "packets"]
+
+results_file = "./benchmark_scaling.json"
+random_seed = 2019
+# Stages quicker than this are too noisy to call superlinear.
+noise_seconds = 1.0
+
+
+def make_names(size):
+    """
+    Returns a names.csv frame with providers spread evenly across clinics.
+    """
+    rows = [["FCN", "FCN", "FCN", "FCN"]]
+    for clinic_number in range(size["clinics"]):
+        clinic = "C{}".format(clinic_number)
+        rows.append(["Clinic " + clinic, clinic, "Clinic", clinic])
+        for provider_number in range(size["providers"]):
+            last_name = "Provider{}x{}".format(clinic_number, provider_number)
+            rows.append(
+                [last_name + " MD, Pat", "Pat " + last_name, "Individual", clinic]
+            )
+    names_df = pd.DataFrame(rows, columns=["MeridiosName", "Name", "Type", "Clinic"])
+    names_df.index.name = "Index"
+    return names_df
+
+
+def make_metrics(size):
+    """
+    Returns a metrics.csv frame of Main metrics, every other one with a target.
+    The first take the names of the real Main metrics, since the PDF page
+    places their charts by name.
+    """
+    real_df = pd.read_csv("./files/metrics.csv")
+    real_metrics = sorted(real_df[(real_df["Main"] == "Main")].Metric.unique())
+    rows = []
+    for metric_number in range(size["metrics"]):
+        if metric_number < len(real_metrics):
+            metric = real_metrics[metric_number]
+        else:
+            metric = "Metric {}".format(metric_number)
+        target = 0.8 if metric_number % 2 == 0 else None
+        rows.append([metric + " Screening", metric, target, "Screening", "Main"])
+    metrics_df = pd.DataFrame(
+        rows, columns=["MeridiosMetric", "Metric", "Target", "Metric Category", "Main"]
+    )
+    metrics_df.index.name = "Index"
+    return metrics_df
+
+
+def make_export(names_df, metrics_df, date, rng):
+    """
+    Returns one weekly Meridios export with a row per provider and clinic for
+    every metric. Clinic rows are the sums of their providers, as Meridios
+    reports them.
+    """
+    providers = names_df[(names_df["Type"] == "Individual")]
+    provider_rows = pd.DataFrame(
+        {
+            "NAME": np.repeat(providers.MeridiosName.values, len(metrics_df)),
+            "Clinic": np.repeat(providers.Clinic.values, len(metrics_df)),
+            "Metricname": np.tile(metrics_df.MeridiosMetric.values, len(providers)),
+        }
+    )
+    provider_rows["SeenDenom"] = rng.integers(20, 400, len(provider_rows))
+    provider_rows["SeenNum"] = rng.binomial(
+        provider_rows["SeenDenom"], rng.uniform(0.3, 0.95, len(provider_rows))
+    )
+    clinic_rows = provider_rows.groupby(["Clinic", "Metricname"], as_index=False)[
+        ["SeenNum", "SeenDenom"]
+    ].sum()
+    clinic_rows["NAME"] = "Clinic " + clinic_rows["Clinic"]
+    export_df = pd.concat([provider_rows, clinic_rows], ignore_index=True)
+    export_df["SeenAvg"] = round(export_df["SeenNum"] / export_df["SeenDenom"], 4)
+    export_df["LastUpdate"] = date.isoformat()
+    return export_df[
+        ["NAME", "Metricname", "SeenNum", "SeenDenom", "SeenAvg", "LastUpdate"]
+    ]
+
+
+def make_synthetic_data(folder, size):
+    """
+    Writes a build tree in folder: weekly exports in data/, and files/ with
+    generated names.csv and metrics.csv next to the real templates and assets.
+    """
+    rng = np.random.default_rng(random_seed)
+    shutil.copytree(
+        "./files", folder + "/files", ignore=shutil.ignore_patterns("*.csv")
+    )
+    os.makedirs(folder + "/data")
+    os.makedirs(folder + "/docs")
+    names_df = make_names(size)
+    metrics_df = make_metrics(size)
+    names_df.to_csv(folder + "/files/names.csv")
+    metrics_df.to_csv(folder + "/files/metrics.csv")
+
+    start_date = datetime.datetime(2018, 1, 1)
+    for week in range(size["weeks"]):
+        date = start_date + datetime.timedelta(weeks=week)
+        make_export(names_df, metrics_df, date, rng).to_csv(
+            folder
+            + "/data/"
+            + date.strftime("%m.%d.%Y")
+            + " ProviderGroupQualityReports.csv",
+            index=False,
+        )
+
+
+def available_stages():
+    """
+    Returns the benchmark stages this machine can run, and why the others
+    are skipped. PDFs lay out the SVGs, so they need both.
+    """
+    skipped = {}
+    if not (
+        importlib.util.find_spec("vl_convert") or importlib.util.find_spec("selenium")
+    ):
+        skipped["svgs"] = "no vl-convert or Selenium to render them"
+    try:
+        import weasyprint  # noqa: F401
+    except (ImportError, OSError) as error:
+        skipped["pdf"] = "WeasyPrint can't be loaded ({})".format(
+            str(error).splitlines()[0]
+        )
+    if "svgs" in skipped and "pdf" not in skipped:
+        skipped["pdf"] = "it needs the SVGs"
+    if "pdf" in skipped:
+        skipped["packets"] = "they are joined from the PDFs"
+    stages = [stage for stage in benchmark_stages if stage not in skipped]
+    return stages, skipped
+
+
+def run_build(size, stages):
+    """
+    Builds the given stages of the site for a synthetic network of the given
+    size in a scratch folder. Returns the build's stage timings.
+    """
+    folder = tempfile.mkdtemp(prefix="benchmark_scaling_")
+    try:
+        make_synthetic_data(folder, size)
+        shutil.copy("./make_website.py", folder)
+        start_time = time.time()
+        subprocess.run(
+            [sys.executable, "make_website.py", "--stages"] + stages,
+            cwd=folder,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        with open(folder + "/build_timings.json", "r", encoding="utf-8") as timings:
+            report = json.load(timings)
+        report["wall_seconds"] = round(time.time() - start_time, 3)
+        return report
+    finally:
+        shutil.rmtree(folder)
+
+
+def scaling_runs():
+    """
+    Returns the sizes to benchmark: the 1x network, then each dimension
+    scaled on its own.
+    """
+    runs = [("base", 1, dict(base_size))]
+    for dimension in dimensions:
+        for scale in scales:
+            if scale != 1:
+                size = dict(base_size)
+                size[dimension] = base_size[dimension] * scale
+                runs.append((dimension, scale, size))
+    return runs
+
+
+def stage_memory(stage):
+    """
+    Returns a stage's peak memory and where it was measured: a worker's
+    memory as a task started plus the most a task added, for stages run on
+    workers, or else the main process's peak during the stage.
+    """
+    if "task_rss_mb" in stage:
+        return stage["worker_start_rss_mb"] + stage["task_rss_mb"], "worker"
+    return stage["peak_rss_mb"], "main"
+
+
+def print_scaling(results):
+    """
+    Prints throughput and peak memory per stage. A stage whose time grows
+    more than twice as fast as the dimension it was scaled by is flagged as
+    superlinear.
+    """
+    base_stages = {stage["stage"]: stage for stage in results[0]["stages"]}
+    for result in results:
+        print(
+            "\n{} {}x: {:.1f}s total".format(
+                result["dimension"], result["scale"], result["wall_seconds"]
+            )
+        )
+        for stage in result["stages"]:
+            base = base_stages.get(stage["stage"])
+            superlinear = (
+                base
+                and base["wall_seconds"]
+                and stage["wall_seconds"] > noise_seconds
+                and stage["wall_seconds"] > 2 * result["scale"] * base["wall_seconds"]
+            )
+            memory_mb, measured_in = stage_memory(stage)
+            print(
+                "  {:16} {:>9} items {:>9.1f} items/sec {:>7.0f} MB {:6}{}".format(
+                    stage["stage"],
+                    stage["items"],
+                    stage["items"] / stage["wall_seconds"]
+                    if stage["wall_seconds"]
+                    else 0,
+                    memory_mb,
+                    measured_in,
+                    "  superlinear" if superlinear else "",
+                )
+            )
+
+
+def main():
+    stages, skipped = available_stages()
+    print("Benchmarking stages: " + ", ".join(stages))
+    for stage, reason in skipped.items():
+        print("Skipping the {} stage: {}".format(stage, reason))
+    results = []
+    for dimension, scale, size in scaling_runs():
+        report = run_build(size, stages)
+        results.append(
+            {
+                "dimension": dimension,
+                "scale": scale,
+                "size": size,
+                "stages_run": stages,
+                "stages_skipped": skipped,
+                "wall_seconds": report["wall_seconds"],
+                "stages": report["stages"],
+            }
+        )
+        print(
+            "{} {}x built in {:.1f}s".format(dimension, scale, report["wall_seconds"])
+        )
+
+    with open(results_file, "w", encoding="utf-8") as resultsfile:
+        json.dump(results, resultsfile, indent=2)
+    print_scaling(results)
+    if skipped:
+        print("\nNot timed: " + ", ".join(skipped))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,11 @@
 <script>
+function resolveSharedData(spec) {
+    var shared = spec.usermeta.shared;
+    for (var name in shared) {
+        spec.datasets[name] = shared_datasets[shared[name][0]][shared[name][1]];
+    }
+}
+
     <!--JSON-->
     
 vegaEmbed("#Colorectal_Screen", Colorectal_Screen, {actions: false}).then(function(result) {}).catch(console.error);
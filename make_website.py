@@ -1,22 +1,52 @@
 #!/home/jkploudre/miniconda3/bin/python3
 
+import argparse
+import collections
+import contextlib
+import copy
 import glob as glob
+import hashlib
+import http.server
+import importlib.util
+import io
 import os
+import queue
 import shutil
 import datetime as datetime
-from multiprocessing import Pool
+import functools
+import multiprocessing
+import multiprocessing.util
+import resource
+import time
 import jinja2
 import json
+import mimetypes
+import urllib.parse
+import subprocess
+import sys
+import numpy as np
 import pandas as pd
-import altair as alt
-from weasyprint import HTML
 import tqdm as tqdm
-from selenium import webdriver
+
+# Altair, WeasyPrint, Selenium, vl-convert, pypdf and pyarrow are slow to
+# import and only needed by some stages, so they are imported where those
+# run. The optional ones are checked for without importing them.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+vl_convert_installed = importlib.util.find_spec("vl_convert") is not None
+pypdf_installed = importlib.util.find_spec("pypdf") is not None
+pyarrow_installed = importlib.util.find_spec("pyarrow") is not None
 
 create_graphs = True
 create_svgs = True
 create_htmls = True
 create_pdfs = True
+create_packets = True
+run_benchmarks = False
 
 names = pd.read_csv("./files/names.csv", index_col="MeridiosName")
 metrics = pd.read_csv(
@@ -25,6 +55,11 @@ metrics = pd.read_csv(
 
 graphing_start_date = "1/1/2018"
 graphing_end_date = "12/31/2019"
+# Levels above what Meridios reports, built by summing the level below. A
+# child's parent is read from the names.csv column named after the parent Type,
+# or is the single entity of that Type when names.csv has no such column.
+rollup_levels = [("Clinic", "FCN")]
+
 dark_purple = "#9467bd"
 light_purple = "#c5b0d5"
 dark_orange = "#ff7f0e"
@@ -34,83 +69,959 @@ light_blue = "#aec7e8"
 dark_green = "#2ca02c"
 light_green = "#98df8a"
 
-df = pd.DataFrame()
+cache_folder = "./cache/"
+ingest_cache_version = 2
+# With pyarrow installed, the cleaned and rolled up records are kept in
+# store_folder as one Arrow IPC file per report date, which is memory-mapped
+# instead of parsing the exports again. New report dates are appended, and a
+# date is rewritten only when its exports or the lookups change. A date whose
+# exports have left ./data is dropped, unless it was archived to keep it.
+store_folder = "./store/"
+store_version = 1
+archive_dates = []
+drop_dates = []
+# Rendered charts are kept until the cache outgrows this, oldest use first.
+chart_cache_limit = 256 * 1024 * 1024
+
+# Every run writes how long each stage took, with its slowest entities.
+timing_report_file = "./build_timings.json"
+slowest_count = 10
+build_start_time = time.time()
+stage_timings = []
+# Each stage measures its own peak memory, so the process's peak before the
+# last reset is kept for the run's.
+lifetime_peak = {"mb": 0.0}
+# The most memory a pool worker held as one of its tasks started, and the
+# most a single task added on top of that.
+worker_memory = {"start_mb": 0.0, "task_mb": 0.0}
+# Seconds to the first page written, plus import and dataset load times when
+# the benchmarks run.
+startup_seconds = {}
+
+# Set to a number of MB to keep the build under it. The pool then gets as
+# many workers as fit beside the main process, and tasks only start while
+# what they add fits too, going by the worker memory of the last run's timing
+# report. Workers are replaced after each task, so an idle one holds no more
+# than a fresh one, and payloads spill to disk sooner.
+memory_budget_mb = None
+# Worker processes per stage. None runs one per CPU.
+max_workers = None
+# How pool workers are started: "fork", "spawn" or "forkserver". None uses
+# the platform default. Workers map the dataset from disk either way.
+start_method = None
+
+# Providers, clinics and metrics to rebuild. Empty lists rebuild everything.
+# A provider or clinic brings along the pages and PDFs that show it: its
+# clinic's page and packet, and the FCN page and packet. Metrics limit which
+# SVGs are rendered again; pages keep every metric from the chart cache.
+selected_providers = []
+selected_clinics = []
+selected_metrics = []
+build_stages = ["charts", "svgs", "html", "pdf", "packets"]
+# The stages whose results each stage is passed, run along with it when
+# left out. Charts for pages come from the chart cache, so they are cheap.
+stage_inputs = {
+    "charts": [],
+    "svgs": [],
+    "html": ["charts"],
+    "pdf": ["html"],
+    "packets": ["pdf"],
+}
+
+# Watch mode checks ./data and ./files this often, and rebuilds once they
+# have been quiet for watch_quiet_seconds, so an export still being copied
+# in is not read half written.
+watch_interval = 2
+watch_quiet_seconds = 5
+
+# The preview server keeps up to this many bytes of rendered responses in
+# memory, dropping the least recently used first.
+preview_port = 8000
+preview_cache_limit = 64 * 1024 * 1024
+
+
+def parse_arguments():
+    """
+    Reads the command line. Options left out keep the settings above.
+    """
+    parser = argparse.ArgumentParser(
+        description="Builds the quality website in ./docs from the exports in ./data."
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=build_stages,
+        help="build stages to run, with the stages they need (default: all)",
+    )
+    parser.add_argument(
+        "--providers",
+        nargs="+",
+        default=[],
+        metavar="NAME",
+        help="providers to rebuild",
+    )
+    parser.add_argument(
+        "--clinics", nargs="+", default=[], metavar="NAME", help="clinics to rebuild"
+    )
+    parser.add_argument(
+        "--metrics", nargs="+", default=[], metavar="METRIC", help="metrics to render"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="worker processes per stage (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--start-method",
+        choices=multiprocessing.get_all_start_methods(),
+        help="how worker processes are started (default: the platform's)",
+    )
+    parser.add_argument(
+        "--memory-budget", type=float, metavar="MB", help="keep the build under MB"
+    )
+    parser.add_argument(
+        "--benchmarks", action="store_true", help="time chart and JSON encoding"
+    )
+    parser.add_argument(
+        "--archive-date",
+        nargs="+",
+        default=[],
+        type=store_date,
+        metavar="DATE",
+        help="keep these report dates in the store once their exports leave ./data",
+    )
+    parser.add_argument(
+        "--drop-date",
+        nargs="+",
+        default=[],
+        type=store_date,
+        metavar="DATE",
+        help="remove these archived report dates from the store",
+    )
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const=preview_port,
+        type=int,
+        metavar="PORT",
+        help="preview the site, rendering each page on first request",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, rebuilding what changes in ./data and ./files",
+    )
+    return parser.parse_args()
+
+
+def with_input_stages(stages):
+    """
+    Returns the stages, with the stages they are built from, in build order.
+    """
+    needed = set(stages)
+    for stage in reversed(build_stages):
+        if stage in needed:
+            needed.update(stage_inputs[stage])
+    return [stage for stage in build_stages if stage in needed]
+
+
+def apply_arguments(arguments):
+    """
+    Overrides the settings above with the options given on the command line.
+    """
+    global create_graphs, create_svgs, create_htmls, create_pdfs, create_packets
+    global selected_providers, selected_clinics, selected_metrics
+    global max_workers, start_method, memory_budget_mb, run_benchmarks
+    global archive_dates, drop_dates
+    if arguments.stages is not None:
+        stages = with_input_stages(arguments.stages)
+        added = [stage for stage in stages if stage not in arguments.stages]
+        if added:
+            print("Also running {}, to build the stages given".format(", ".join(added)))
+        create_graphs = "charts" in stages
+        create_svgs = "svgs" in stages
+        create_htmls = "html" in stages
+        create_pdfs = "pdf" in stages
+        create_packets = "packets" in stages
+    selected_providers = arguments.providers or selected_providers
+    selected_clinics = arguments.clinics or selected_clinics
+    selected_metrics = arguments.metrics or selected_metrics
+    max_workers = arguments.workers or max_workers
+    start_method = arguments.start_method or start_method
+    if arguments.memory_budget is not None:
+        memory_budget_mb = arguments.memory_budget
+    run_benchmarks = arguments.benchmarks or run_benchmarks
+    archive_dates = arguments.archive_date or archive_dates
+    drop_dates = arguments.drop_date or drop_dates
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def lifetime_peak_rss_mb():
+    return max(lifetime_peak["mb"], peak_rss_mb())
+
+
+def reset_peak_rss():
+    """
+    Restarts this process's peak memory from what it holds now, where Linux
+    allows it. Returns the peak to measure a task's or stage's growth from.
+    Elsewhere it is the lifetime peak, so a task only shows growth past
+    earlier ones.
+    """
+    lifetime_peak["mb"] = lifetime_peak_rss_mb()
+    with contextlib.suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    return peak_rss_mb()
+
+
+def last_stage_memory():
+    """
+    Returns the worker memory of each stage in the last run, if any: the
+    most a worker held as one of the stage's tasks started, and the most a
+    task added on top.
+    """
+    if not os.path.isfile(timing_report_file):
+        return {}
+    with open(timing_report_file, "r", encoding="utf-8") as reportfile:
+        stages = json.load(reportfile)["stages"]
+    return {
+        stage["stage"]: (stage["worker_start_rss_mb"], stage["task_rss_mb"])
+        for stage in stages
+        if "task_rss_mb" in stage
+    }
+
+
+def stage_memory(stage):
+    """
+    Returns the memory of an idle worker and what one of the stage's tasks
+    adds, going by the last run. Before there is one, a worker is taken to
+    be the size of the main process.
+    """
+    return last_stage_memory().get(stage, (peak_rss_mb(), 0.0))
+
+
+def stage_workers(stage):
+    """
+    Returns how many workers a stage can run at once within the memory
+    budget. Worker memory counts pages shared with the main process, so this
+    errs on the side of fewer workers. Without a budget, one per CPU.
+    """
+    cpu_workers = max_workers or os.cpu_count()
+    if memory_budget_mb is None:
+        return cpu_workers
+    worker_mb = sum(stage_memory(stage))
+    return max(
+        1, min(cpu_workers, int((memory_budget_mb - peak_rss_mb()) // worker_mb))
+    )
+
+
+def timed(function, *args, **kwargs):
+    """
+    Calls function, returning its result with the wall and CPU seconds it took.
+    """
+    start_time, start_cpu = time.time(), time.process_time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start_time, time.process_time() - start_cpu
+
+
+def timed_in_worker(function, *args, **kwargs):
+    """
+    Like timed, adding the worker's memory as the call started and how much
+    the call added to it at its peak.
+    """
+    start_mb = reset_peak_rss()
+    result = timed(function, *args, **kwargs)
+    return result + (start_mb, max(0.0, peak_rss_mb() - start_mb))
+
+
+def record_worker_memory(stage, results):
+    """
+    Notes the worker memory of a stage's tasks, from the start and task MB of
+    each of their results, for the stage and for the whole run.
+    """
+    stage["worker_start_mb"] = max(start_mb for start_mb, _ in results)
+    stage["task_mb"] = max(task_mb for _, task_mb in results)
+    worker_memory["start_mb"] = max(worker_memory["start_mb"], stage["worker_start_mb"])
+    worker_memory["task_mb"] = max(worker_memory["task_mb"], stage["task_mb"])
+
+
+def slowest_items(item_seconds):
+    slowest = sorted(item_seconds.items(), key=lambda item: -item[1])
+    return [
+        {"name": name, "seconds": round(seconds, 3)}
+        for name, seconds in slowest[:slowest_count]
+    ]
+
+
+def record_stage(
+    stage,
+    wall_seconds,
+    cpu_seconds,
+    items,
+    item_seconds=None,
+    metric_seconds=None,
+    worker_start_mb=None,
+    task_mb=None,
+):
+    """
+    Adds a stage to the timing report. item_seconds maps the stage's
+    entities to their seconds, and metric_seconds its metrics, for the
+    slowest of them. Peak memory is the main process's high-water mark since
+    the stage started, or since the task run started for the stages run on
+    workers, which overlap. Those add the most a worker held as a task
+    started, and the most a task added to it.
+    """
+    record = {
+        "stage": stage,
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "items": items,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "slowest": slowest_items(item_seconds or {}),
+    }
+    if task_mb is not None:
+        record["worker_start_rss_mb"] = round(worker_start_mb, 1)
+        record["task_rss_mb"] = round(task_mb, 1)
+    if metric_seconds:
+        record["slowest_metrics"] = slowest_items(metric_seconds)
+    stage_timings.append(record)
+
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """
+    Times the block as one stage of the timing report. The block can fill in
+    the yielded record's item count, per entity seconds and worker CPU time.
+    """
+    record = {"items": 0, "item_seconds": {}, "worker_cpu_seconds": 0.0}
+    reset_peak_rss()
+    start_time, start_cpu = time.time(), time.process_time()
+    yield record
+    record_stage(
+        stage,
+        time.time() - start_time,
+        time.process_time() - start_cpu + record["worker_cpu_seconds"],
+        record["items"],
+        record["item_seconds"],
+        worker_start_mb=record.get("worker_start_mb"),
+        task_mb=record.get("task_mb"),
+    )
+
+
+def write_timing_report():
+    """
+    Writes the stage timings of this run next to ./docs.
+    """
+    report = {
+        "started": datetime.datetime.fromtimestamp(build_start_time).isoformat(),
+        "wall_seconds": round(time.time() - build_start_time, 3),
+        "cpu_count": os.cpu_count(),
+        "memory_budget_mb": memory_budget_mb,
+        "peak_rss_mb": round(lifetime_peak_rss_mb(), 1),
+        "worker_start_rss_mb": round(worker_memory["start_mb"], 1),
+        "task_rss_mb": round(worker_memory["task_mb"], 1),
+        "startup_seconds": startup_seconds,
+        "stages": stage_timings,
+    }
+    with open(timing_report_file, "w", encoding="utf-8") as reportfile:
+        json.dump(report, reportfile, indent=2)
+
+
+def file_fingerprint(file):
+    """
+    Identifies one export by path, size, mtime and a hash of its contents.
+    """
+    stat = os.stat(file)
+    with open(file, "rb") as csvfile:
+        content_hash = hashlib.sha1(csvfile.read()).hexdigest()
+    return [file, str(stat.st_size), str(stat.st_mtime_ns), content_hash]
+
+
+def lookup_fingerprint():
+    """
+    Mapped frames depend on names.csv and metrics.csv, so editing either
+    has to invalidate every cached export.
+    """
+    lookup_hash = hashlib.sha1(str(ingest_cache_version).encode())
+    for lookup_file in ["./files/names.csv", "./files/metrics.csv"]:
+        with open(lookup_file, "rb") as csvfile:
+            lookup_hash.update(csvfile.read())
+    return lookup_hash.hexdigest()
 
-files = glob.iglob("./data/*.csv")
-for file in tqdm.tqdm(files, total=len(glob.glob("./data/*csv")), desc="CSV Files"):
+
+def read_report(file):
+    """
+    Reads a single Meridios export and maps it to names and metrics. Raw
+    counts are kept so they can be rolled up before percents are calculated.
+    Assumes: dataframes 'names' and 'metrics' for lookups
+    """
     file_df = pd.read_csv(file, usecols=["NAME", "Metricname", "SeenNum", "SeenDenom"])
     file_df["Name"] = file_df.NAME.map(names.Name)
     file_df["Type"] = file_df.NAME.map(names.Type)
     file_df["Clinic"] = file_df.NAME.map(names.Clinic)
     file_df["Metric"] = file_df.Metricname.map(metrics.Metric)
 
-    # Meridios report doesn't have FCN summary so create it from clinic data.
-    clinics_df = file_df[(file_df["Type"] == "Clinic")]
-    fcn_data = []
-    for metric in clinics_df.Metric.unique():
-        metric_df = clinics_df[(clinics_df["Metric"] == metric)]
-        fcn_numerator = metric_df.SeenNum.sum()
-        fcn_denominator = metric_df.SeenDenom.sum()
-        dataline = ("", "", fcn_numerator, fcn_denominator, "FCN", "FCN", "FCN", metric)
-        fcn_data.append(dataline)
-    fcn_df = pd.DataFrame.from_records(fcn_data, columns=metric_df.columns)
-    file_df = file_df.append(fcn_df, ignore_index=True)
+    file_df["Date"] = report_date(file)
+    return file_df
+
+
+def report_date(file):
+    """
+    Meridios reports have unreliable datetimes. Uses Zero-Padded date on
+    filename for the date column.
+    """
+    filename_parts = os.path.basename(file)[:-4].split(" ")
+    if len(str(filename_parts[0])) == 10:
+        return datetime.datetime.strptime(filename_parts[0], "%m.%d.%Y")
+    raise ValueError("Oops, CSV Filename require Zero Padded Dates")
+
+
+def load_report(file, lookup_hash):
+    """
+    Returns the mapped frame for one export, from the ingest cache when the
+    file and the lookups are unchanged since it was last read.
+    """
+    key = hashlib.sha1(
+        "|".join(file_fingerprint(file) + [lookup_hash]).encode()
+    ).hexdigest()
+    cachefile = cache_folder + "ingest/" + key + ".pkl"
+    if os.path.isfile(cachefile):
+        return key, pd.read_pickle(cachefile)
+    file_df = read_report(file)
+    if not os.path.exists(cache_folder + "ingest/"):
+        os.makedirs(cache_folder + "ingest/")
+    file_df.to_pickle(cachefile + ".tmp")
+    os.replace(cachefile + ".tmp", cachefile)
+    return key, file_df
+
+
+def prune_ingest_cache(keys):
+    """
+    Removes cached exports that no longer match any file in ./data.
+    """
+    for cachefile in glob.glob(cache_folder + "ingest/*.pkl"):
+        if os.path.basename(cachefile)[:-4] not in keys:
+            os.remove(cachefile)
+
+
+def print_load_rate(files, elapsed):
+    """
+    Prints the files loaded per second, and the peak memory of the main
+    process and the ingest workers.
+    """
+    print(
+        "Loaded {} files in {:.1f}s ({:.1f} files/sec), peak memory {:.0f} MB, "
+        "workers {:.0f} MB".format(
+            len(files),
+            elapsed,
+            len(files) / elapsed if elapsed else 0,
+            lifetime_peak_rss_mb(),
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        )
+    )
+
+
+def load_reports(files):
+    """
+    Parses the exports across a process pool and concatenates them once.
+    Reports throughput and peak memory so ingest can be watched as ./data grows.
+    """
+    start_time = time.time()
+    with timed_stage("ingest") as stage:
+        pool = multiprocessing.get_context(start_method).Pool(stage_workers("ingest"))
+        loaded = list(
+            tqdm.tqdm(
+                pool.imap(
+                    functools.partial(
+                        timed_in_worker, load_report, lookup_hash=lookup_fingerprint()
+                    ),
+                    files,
+                ),
+                total=len(files),
+                desc="CSV Files",
+            )
+        )
+        pool.close()
+        pool.join()
+        prune_ingest_cache(set(result[0][0] for result in loaded))
+        loaded_df = pd.concat([result[0][1] for result in loaded], ignore_index=True)
+        stage["items"] = len(files)
+        stage["item_seconds"] = {file: result[1] for file, result in zip(files, loaded)}
+        stage["worker_cpu_seconds"] = sum(result[2] for result in loaded)
+        record_worker_memory(stage, [result[3:] for result in loaded])
+
+    print_load_rate(files, time.time() - start_time)
+    return loaded_df
+
+
+def parent_names(child_df, parent_type, entities):
+    """
+    Returns the parent of each child row, from the names.csv column named
+    after the parent Type, or the single entity of that Type.
+    """
+    if parent_type in entities.columns:
+        return child_df.Name.map(entities[parent_type])
+    return entities[(entities["Type"] == parent_type)].index[0]
+
+
+def rollup(report_df):
+    """
+    Adds the summary levels that Meridios doesn't report by summing the raw
+    counts of the level below, then calculates percents for every row.
+    Assumes: dataframe 'names' for the hierarchy
+    """
+    entities = names.drop_duplicates("Name").set_index("Name")
+    for child_type, parent_type in rollup_levels:
+        child_df = report_df[(report_df["Type"] == child_type)]
+        parent_df = (
+            child_df.assign(Name=parent_names(child_df, parent_type, entities))
+            .groupby(["Name", "Metric", "Date"], as_index=False)[
+                ["SeenNum", "SeenDenom"]
+            ]
+            .sum()
+        )
+        parent_df["Type"] = parent_type
+        parent_df["Clinic"] = parent_df.Name.map(entities.Clinic)
+        parent_df["NAME"] = ""
+        parent_df["Metricname"] = ""
+        report_df = pd.concat([report_df, parent_df], ignore_index=True)
 
     # Manually Calculate percents, reduce precision.
-    file_df["%"] = round(file_df["SeenNum"] / file_df["SeenDenom"], 4)
-    file_df.drop(["SeenNum", "SeenDenom"], axis=1, inplace=True)
-
-    # Meridios reports have unreliable datetimes. Uses Zero-Padded date on
-    # filename for the date column.
-    filename_parts = file[7:-4].split(" ")
-    if len(str(filename_parts[0])) is 10:
-        file_df["Date"] = datetime.datetime.strptime(filename_parts[0], "%m.%d.%Y")
-        df = df.append(file_df)
-    else:
-        raise ValueError("Oops, CSV Filename require Zero Padded Dates")
+    report_df["%"] = round(report_df["SeenNum"] / report_df["SeenDenom"], 4)
+    return report_df
+
+
+def check_report(report_df):
+    """
+    Prints the rows with percents out of range. Returns the names in the
+    exports that names.csv doesn't have, with the blank name of rolled up rows.
+    """
+    big_error_df = report_df[(report_df["%"] > 1)]
+    if not big_error_df.empty:
+        print("Percentages can't be over 100:\n", big_error_df)
+
+    under_zero_df = report_df[(report_df["%"] < 0)]
+    if not under_zero_df.empty:
+        print("Percentages can't be less than 0:\n", under_zero_df)
+    return set(report_df.NAME.unique()) - set(names.index.unique())
+
+
+def clean_report(report_df):
+    report_df = report_df.drop(["NAME", "Metricname"], axis=1)
+    return report_df.dropna(subset=["Name", "Metric"])
+
+
+def compact(report_df):
+    """
+    Stores the labels as categoricals, percents as float32 and counts as
+    int32, so the frame stays small and masks compare codes, not strings.
+    """
+    # Blank counts were already summed as zero by the rollup.
+    return report_df.fillna({"SeenNum": 0, "SeenDenom": 0}).astype(
+        {
+            "Name": "category",
+            "Type": "category",
+            "Clinic": "category",
+            "Metric": "category",
+            "%": "float32",
+            "SeenNum": "int32",
+            "SeenDenom": "int32",
+        }
+    )
+
+
+def store_date(date):
+    return pd.Timestamp(date).strftime("%Y-%m-%d")
+
+
+def store_file(date):
+    return store_folder + date + ".arrow"
+
+
+def read_store_manifest():
+    """
+    Returns the store's manifest: for each report date, the exports and
+    lookups it was cleaned from.
+    """
+    manifest_file = store_folder + "manifest.json"
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as manifestfile:
+            manifest = json.load(manifestfile)
+        if manifest["version"] == store_version:
+            return manifest
+    return {"version": store_version, "dates": {}}
+
+
+def write_store_manifest(manifest):
+    manifest_file = store_folder + "manifest.json"
+    with open(manifest_file + ".tmp", "w", encoding="utf-8") as manifestfile:
+        json.dump(manifest, manifestfile, indent=2, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def exports_fingerprint(files):
+    return hashlib.sha1(
+        "|".join(part for file in files for part in file_fingerprint(file)).encode()
+    ).hexdigest()
+
+
+def store_exports(files, lookup_hash):
+    """
+    Cleans the exports of one report date and writes them to the store,
+    replacing what it held for that date. The rollup only sums within a
+    date, so each date is rolled up on its own.
+    Returns: the date's manifest entry, and the names missing from names.csv
+    """
+    import pyarrow.feather
+
+    report_df = rollup(
+        pd.concat([read_report(file) for file in files], ignore_index=True)
+    )
+    missing = check_report(report_df)
+    report_df = compact(clean_report(report_df)).reset_index(drop=True)
+    date = report_date(files[0]).strftime("%Y-%m-%d")
+    if not os.path.exists(store_folder):
+        os.makedirs(store_folder)
+    # Uncompressed, so readers can memory-map the columns they need.
+    pyarrow.feather.write_feather(
+        report_df, store_file(date) + ".tmp", compression="uncompressed"
+    )
+    os.replace(store_file(date) + ".tmp", store_file(date))
+    entry = {
+        "exports": files,
+        "fingerprint": exports_fingerprint(files),
+        "lookups": lookup_hash,
+        "rows": len(report_df),
+    }
+    return entry, missing
+
+
+def prune_store(manifest, date_files):
+    """
+    Drops the report dates whose exports have left ./data from the store,
+    unless they were archived, and the archived dates asked to be dropped.
+    Marks the dates asked to be archived. Returns whether the manifest changed.
+    """
+    changed = False
+    for date in archive_dates:
+        if date not in manifest["dates"]:
+            print("No report date {} in the store to archive".format(date))
+        elif not manifest["dates"][date].get("archived"):
+            manifest["dates"][date]["archived"] = True
+            changed = True
+    for date in drop_dates:
+        if date in date_files:
+            print("Not dropping {}, its exports are still in ./data".format(date))
+        elif date in manifest["dates"]:
+            manifest["dates"][date]["archived"] = False
+    dropped = [
+        date
+        for date, entry in manifest["dates"].items()
+        if date not in date_files and not entry.get("archived")
+    ]
+    for date in dropped:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(store_file(date))
+        del manifest["dates"][date]
+    if dropped:
+        print(
+            "Dropped {} report dates whose exports left ./data: {}".format(
+                len(dropped), ", ".join(sorted(dropped))
+            )
+        )
+    return changed or bool(dropped)
+
+
+def update_store(files):
+    """
+    Appends the report dates of new exports to the store across a process
+    pool, and rewrites the dates whose exports or lookups changed. Dates
+    whose exports have left ./data are dropped unless archived, so the store
+    holds what ./data does plus the history asked for. Reports throughput
+    and peak memory like load_reports.
+    """
+    start_time = time.time()
+    lookup_hash = lookup_fingerprint()
+    manifest = read_store_manifest()
+    date_files = {}
+    for file in files:
+        date_files.setdefault(report_date(file).strftime("%Y-%m-%d"), []).append(file)
+    stale = [
+        date_files[date]
+        for date in sorted(date_files)
+        if manifest["dates"].get(date, {}).get("lookups") != lookup_hash
+        or manifest["dates"][date]["fingerprint"]
+        != exports_fingerprint(date_files[date])
+    ]
+    with timed_stage("ingest") as stage:
+        if stale:
+            pool = multiprocessing.get_context(start_method).Pool(
+                stage_workers("ingest")
+            )
+            stored = list(
+                tqdm.tqdm(
+                    pool.imap(
+                        functools.partial(
+                            timed_in_worker, store_exports, lookup_hash=lookup_hash
+                        ),
+                        stale,
+                    ),
+                    total=len(stale),
+                    desc="Report Dates",
+                )
+            )
+            pool.close()
+            pool.join()
+            missing = set()
+            for stale_files, ((entry, date_missing), _, _, _, _) in zip(stale, stored):
+                manifest["dates"][
+                    report_date(stale_files[0]).strftime("%Y-%m-%d")
+                ] = entry
+                missing |= date_missing
+            write_store_manifest(manifest)
+            if len(missing) > 1:
+                print("Missing Provider in names.csv:\n", missing)
+            stage["item_seconds"] = {
+                stale_files[0]: result[1] for stale_files, result in zip(stale, stored)
+            }
+            stage["worker_cpu_seconds"] = sum(result[2] for result in stored)
+            record_worker_memory(stage, [result[3:] for result in stored])
+        stage["items"] = sum(len(stale_files) for stale_files in stale)
+    if prune_store(manifest, date_files):
+        write_store_manifest(manifest)
+
+    kept = [
+        date
+        for date, entry in manifest["dates"].items()
+        if date not in date_files and entry["lookups"] != lookup_hash
+    ]
+    if kept:
+        print(
+            "Kept {} archived report dates mapped with older lookups, their "
+            "exports are gone".format(len(kept))
+        )
+    elapsed = time.time() - start_time
+    if stale:
+        print(
+            "Stored {} report dates from {} files in {:.1f}s, store has {} dates".format(
+                len(stale),
+                sum(len(stale_files) for stale_files in stale),
+                elapsed,
+                len(manifest["dates"]),
+            )
+        )
+    print_load_rate(files, elapsed)
+
 
+def query_store(columns=None, start_date=None, end_date=None):
+    """
+    Returns the stored records from start_date to end_date, inclusive, as a
+    frame. Only the files of those report dates are opened, and only the
+    columns asked for are read from their memory maps.
+    """
+    import pyarrow
+    import pyarrow.feather
+
+    dates = sorted(read_store_manifest()["dates"])
+    if start_date is not None:
+        start_date = store_date(start_date)
+        dates = [date for date in dates if date >= start_date]
+    if end_date is not None:
+        end_date = store_date(end_date)
+        dates = [date for date in dates if date <= end_date]
+    tables = [
+        pyarrow.feather.read_table(store_file(date), columns=columns, memory_map=True)
+        for date in dates
+    ]
+    # Dates have their own dictionaries for the categorical columns.
+    report_df = pyarrow.concat_tables(tables, promote_options="permissive").to_pandas()
+    for column in report_df.columns:
+        if isinstance(report_df[column].dtype, pd.CategoricalDtype):
+            report_df[column] = report_df[column].cat.reorder_categories(
+                sorted(report_df[column].cat.categories)
+            )
+    return report_df
 
-if len(set(df.NAME.unique()) - set(names.index.unique())) > 1:
+
+@functools.lru_cache(maxsize=None)
+def load_dataset():
+    """
+    Returns the cleaned, rolled up and compacted dataset of every export in
+    ./data, checked against names.csv and metrics.csv. With pyarrow it is
+    read from the store, after appending any new exports; without, exports
+    come from the ingest cache when unchanged. The frame is kept for the
+    rest of the process, so copy it before changing it.
+    """
+    if pyarrow_installed:
+        update_store(sorted(glob.glob("./data/*.csv")))
+        start_time = time.time()
+        with timed_stage("store") as stage:
+            report_df = query_store()
+            stage["items"] = len(report_df)
+        print(
+            "Dataset: {} rows, {:.1f} MB, read from the store in {:.2f}s".format(
+                len(report_df),
+                report_df.memory_usage(deep=True).sum() / 1024**2,
+                time.time() - start_time,
+            )
+        )
+        return report_df
+
+    raw_df = load_reports(sorted(glob.glob("./data/*.csv")))
+    with timed_stage("rollup") as stage:
+        report_df = rollup(raw_df)
+        stage["items"] = len(report_df)
+
+    missing = check_report(report_df)
+    if len(missing) > 1:
+        print("Missing Provider in names.csv:\n", missing)
+    report_df = clean_report(report_df)
+
+    with timed_stage("compact") as stage:
+        object_size = report_df.memory_usage(deep=True).sum()
+        report_df = compact(report_df)
+        stage["items"] = len(report_df)
     print(
-        "Missing Provider in names.csv:\n",
-        set(df.NAME.unique()) - set(names.index.unique()),
+        "Dataset: {} rows, {:.1f} MB (was {:.1f} MB)".format(
+            len(report_df),
+            report_df.memory_usage(deep=True).sum() / 1024**2,
+            object_size / 1024**2,
+        )
     )
+    return report_df
 
-big_error_df = df[(df["%"] > 1)]
-if not big_error_df.empty:
-    print("Percentages can't be over 100:\n", big_error_df)
 
-under_zero_df = df[(df["%"] < 0)]
-if not under_zero_df.empty:
-    print("Percentages can't be less than 0:\n", under_zero_df)
-df.drop(["NAME"], axis=1, inplace=True)
-df.drop(["Metricname"], axis=1, inplace=True)
-df.dropna(subset=["Name"], inplace=True)
-df.dropna(subset=["Metric"], inplace=True)
+def publish_dataset(report_df):
+    """
+    Writes the dataset, sorted into series, to the dataset cache as one .npy
+    file per column, with categoricals as their codes. Files are named by a
+    hash of the data, so an unchanged dataset is written once.
+    Returns: the layout map_dataset needs to map it back
+    """
+    report_df = report_df.sort_values(["Name", "Metric", "Date"], kind="mergesort")
+    columns = {}
+    categories = {}
+    for column in report_df.columns:
+        if isinstance(report_df[column].dtype, pd.CategoricalDtype):
+            categories[column] = report_df[column].cat.categories.tolist()
+            columns[column] = report_df[column].cat.codes.to_numpy()
+        else:
+            columns[column] = report_df[column].to_numpy()
+    digest = hashlib.sha1(repr(categories).encode())
+    for column, values in columns.items():
+        digest.update(column.encode() + values.dtype.str.encode() + values.tobytes())
+    folder = cache_folder + "dataset/" + digest.hexdigest() + "/"
+    if not os.path.isdir(folder):
+        tmp_folder = folder[:-1] + ".{}.tmp/".format(os.getpid())
+        os.makedirs(tmp_folder)
+        for index, values in enumerate(columns.values()):
+            np.save(tmp_folder + "{}.npy".format(index), values)
+        os.replace(tmp_folder, folder)
+    for old_folder in glob.glob(cache_folder + "dataset/*/"):
+        if old_folder != folder and not old_folder.endswith(".tmp/"):
+            shutil.rmtree(old_folder)
+    return {"folder": folder, "columns": list(columns), "categories": categories}
+
+
+def map_dataset(layout):
+    """
+    Returns the published dataset as a frame over read-only memory maps of
+    its files. Every process that maps it shares the same pages.
+    """
+    columns = {}
+    for index, column in enumerate(layout["columns"]):
+        values = np.load(layout["folder"] + "{}.npy".format(index), mmap_mode="r")
+        if column in layout["categories"]:
+            values = pd.Categorical.from_codes(values, layout["categories"][column])
+        columns[column] = values
+    return pd.DataFrame(columns, copy=False)
 
 
-def make_individual_metric_json(metric, name_df, clinic_df, fcn_df, foldername):
+def build_series_index(report_df):
     """
-    Makes a chart json for a single metric and a single provider.
-    Assumes: dataframes 'names' and 'metrics' for lookups
+    Finds where each (Name, Metric) series starts and stops in the dataset,
+    so chart builders slice out one entity's series instead of masking all
+    of df.
+    Assumes: report_df as published, sorted into date sorted series
     """
+    return {
+        key: (positions[0], positions[-1] + 1)
+        for key, positions in report_df.groupby(
+            ["Name", "Metric"], observed=True
+        ).indices.items()
+    }
 
-    provider_df = name_df[(name_df["Metric"] == metric)]
-    provider_df = provider_df.drop(["Metric"], axis=1)
-    clinic_df = clinic_df[(clinic_df["Metric"] == metric)]
-    clinic_df = clinic_df.drop(["Metric"], axis=1)
-    fcn_df = fcn_df[(fcn_df["Metric"] == metric)]
-    fcn_df = fcn_df.drop(["Metric"], axis=1)
 
-    provider_current_metric = provider_df[provider_df["Date"] == current_date]
+@functools.lru_cache(maxsize=None)
+def get_series(name, metric):
+    """
+    Returns the date sorted rows for one provider, clinic or FCN and metric,
+    as a view of the mapped dataset.
+    """
+    if (name, metric) not in series_index:
+        return empty_series
+    start, stop = series_index[(name, metric)]
+    return df.iloc[start:stop]
 
-    metric_target = metrics[metrics.Metric == metric].iloc[0].Target
 
-    if metric_target:
-        metricdf = pd.DataFrame([{"TargetValue": metric_target, "Title": "Target"}])
+def build_snapshot_table(report_df):
+    """
+    Compares every entity on its parent's first date for each metric against
+    the current date, once per run. Returns the comparison rows keyed by
+    (parent, metric), start rows first.
+    Assumes: dataframe 'names' for the hierarchy
+    """
+    entities = names.drop_duplicates("Name").set_index("Name")
+    start_dates = (
+        report_df.groupby(["Name", "Metric"], observed=True)["Date"]
+        .min()
+        .rename("ParentStart")
+    )
+    snapshot_rows = []
+    for child_type, parent_type in [("Individual", "Clinic")] + rollup_levels:
+        child_df = report_df[(report_df["Type"] == child_type)]
+        child_df = child_df.assign(
+            Parent=parent_names(child_df, parent_type, entities)
+        ).join(start_dates, on=["Parent", "Metric"])
+        snapshot_rows.append(
+            child_df[(child_df["Date"] == child_df["ParentStart"])].assign(
+                Snapshot="Start"
+            )
+        )
+        snapshot_rows.append(
+            child_df[(child_df["Date"] == current_date)].assign(Snapshot="Current")
+        )
+    snapshot_df = pd.concat(snapshot_rows, ignore_index=True)
+    snapshot_df = snapshot_df[
+        ["Parent", "Metric", "Snapshot", "Name", "Date", "%", "SeenNum", "SeenDenom"]
+    ]
+    return {
+        (parent, metric): parent_df
+        for (parent, metric), parent_df in snapshot_df.groupby(
+            ["Parent", "Metric"], observed=True
+        )
+    }
+
+
+def get_start_and_current(parent, metric):
+    """
+    Returns the start and current rows for the children of a clinic or FCN.
+    """
+    snapshot_df = snapshot_table.get((parent, metric), empty_snapshot)
+    return snapshot_df[["Name", "%", "Snapshot"]]
+
+
+def individual_chart(provider, provider_current, clinic, fcn, target):
+    """
+    Builds the progress chart for a single provider and metric.
+    Data arguments are dataframes or alt.NamedData; target is None when the
+    metric has no target.
+    """
+    import altair as alt
 
     provider_progress_line = (
-        alt.Chart(provider_df)
+        alt.Chart(provider)
         .mark_line(strokeWidth=4)
         .encode(
             alt.X(
@@ -129,13 +1040,13 @@ def make_individual_metric_json(metric, name_df, clinic_df, fcn_df, foldername):
     )
 
     provider_current_text = (
-        alt.Chart(provider_current_metric)
+        alt.Chart(provider_current)
         .mark_text(align="right", baseline="top", dx=175, dy=-98, size=16)
         .encode(text=alt.Text("%:Q", format=".2%"), color=alt.ColorValue(dark_purple))
     )
 
     clinic_progress_line = (
-        alt.Chart(clinic_df)
+        alt.Chart(clinic)
         .mark_line(strokeWidth=2)
         .encode(
             alt.X("Date:T", title=""), alt.Y("%:Q"), color=alt.ColorValue(light_orange)
@@ -143,99 +1054,52 @@ def make_individual_metric_json(metric, name_df, clinic_df, fcn_df, foldername):
     )
 
     fcn_progress_line = (
-        alt.Chart(fcn_df)
+        alt.Chart(fcn)
         .mark_line(strokeWidth=2)
         .encode(
             alt.X("Date:T", title=""), alt.Y("%:Q"), color=alt.ColorValue(light_blue)
         )
     )
 
-    if metric_target:
+    if target is not None:
         metric_target_rule = (
-            alt.Chart(metricdf)
+            alt.Chart(target)
             .mark_rule(strokeWidth=1, strokeDash=[4, 2])
             .encode(y="TargetValue:Q", color=alt.ColorValue(dark_green))
         )
         metric_target_text = (
-            alt.Chart(metricdf)
+            alt.Chart(target)
             .mark_text(align="right", baseline="bottom", dx=175, dy=100, size=16)
             .encode(
                 text=alt.Text("TargetValue:Q", format=".2%"),
                 color=alt.ColorValue(dark_green),
             )
         )
-
-        if metric_target:
-            chart = (
-                fcn_progress_line
-                + clinic_progress_line
-                + provider_progress_line
-                + metric_target_rule
-                + metric_target_text
-                + provider_current_text
-            )
-        else:
-            chart = fcn_progress_line + clinic_progress_line + provider_progress_line
-
-    if create_svgs:
-        chart.save(foldername + metric + ".svg", webdriver="firefox")
-
-    return chart.to_json()
-
-
-def save_individual_chart_data(name):
-    json_data = ""
-
-    clinic_name = names[names.Name == name].iloc[0].Clinic
-    name_df = df[(df["Name"] == name)]
-    name_df = name_df.drop(["Name", "Type", "Clinic"], axis=1)
-    clinic_df = df[(df["Name"] == clinic_name)]
-    clinic_df = clinic_df.drop(["Name", "Type", "Clinic"], axis=1)
-    foldername = savefolder(name)
-
-    for metric in main_metrics:
-        chart_data = make_individual_metric_json(
-            metric, name_df, clinic_df, fcn_df, foldername
+        chart = (
+            fcn_progress_line
+            + clinic_progress_line
+            + provider_progress_line
+            + metric_target_rule
+            + metric_target_text
+            + provider_current_text
         )
-        chart_data_json = json.loads(chart_data)
-        json_minified = json.dumps(chart_data_json, separators=(",", ":"))
-        json_data += "var " + metric.replace(" ", "_") + " = " + json_minified + ";\n"
-    with open(foldername + "chart_data.json", "w") as savefile:
-        savefile.write(json_data)
+    else:
+        chart = fcn_progress_line + clinic_progress_line + provider_progress_line
+    return chart
 
 
-def make_clinic_metric_json(metric, clinic_name, clinic_df, fcn_df):
+def clinic_chart(
+    clinic, clinic_current, fcn, start_and_current, current, target, clinic_providers
+):
     """
-    Makes a chart for a single metric and a clinic.
-
-    Assumes: dataframe 'df' that has all the data from CSVs
-    Assumes: dataframes 'names' and 'metrics' for lookups
+    Builds the progress chart and provider ranged dots for a clinic and metric.
+    Data arguments are dataframes or alt.NamedData; target is None when the
+    metric has no target.
     """
-
-    clinic_df = clinic_df[(clinic_df["Metric"] == metric)]
-    clinic_df = clinic_df.drop(["Metric"], axis=1)
-
-    fcn_df = fcn_df[(fcn_df["Metric"] == metric)]
-    fcn_df = fcn_df.drop(["Metric"], axis=1)
-
-    metric_target = metrics[metrics.Metric == metric].iloc[0].Target
-    if metric_target:
-        metricdf = pd.DataFrame([{"TargetValue": metric_target, "Title": "Target"}])
-
-    current_metric = df[
-        (df["Metric"] == metric)
-        & (df["Type"] == "Clinic")
-        & (df["Date"] == current_date)
-    ]
-
-    clinic_current_metric = df[
-        (df["Metric"] == metric)
-        & (df["Name"] == clinic_name)
-        & (df["Date"] == current_date)
-    ]
+    import altair as alt
 
     clinic_progress_line = (
-        alt.Chart(clinic_df)
+        alt.Chart(clinic)
         .mark_line(strokeWidth=4)
         .encode(
             alt.X(
@@ -254,13 +1118,13 @@ def make_clinic_metric_json(metric, clinic_name, clinic_df, fcn_df):
     )
 
     clinic_progress_text = (
-        alt.Chart(clinic_current_metric)
+        alt.Chart(clinic_current)
         .mark_text(align="right", baseline="top", dx=100, dy=-98, size=16)
         .encode(text=alt.Text("%:Q", format=".2%"), color=alt.ColorValue(dark_orange))
     )
 
     fcn_progress_line = (
-        alt.Chart(fcn_df)
+        alt.Chart(fcn)
         .mark_line(strokeWidth=2)
         .encode(
             alt.X("Date:T", title=""),
@@ -273,41 +1137,6 @@ def make_clinic_metric_json(metric, clinic_name, clinic_df, fcn_df):
         )
     )
 
-    if metric_target:
-        metric_target_rule = (
-            alt.Chart(metricdf)
-            .mark_rule(strokeWidth=1, strokeDash=[4, 2])
-            .encode(y="TargetValue:Q", color=alt.ColorValue(dark_green))
-        )
-        metric_target_text = (
-            alt.Chart(metricdf)
-            .mark_text(align="right", baseline="bottom", dx=100, dy=100, size=16)
-            .encode(
-                text=alt.Text("TargetValue:Q", format=".2%"),
-                color=alt.ColorValue(dark_green),
-            )
-        )
-    clinic_providers = sorted(
-        single_providers[single_providers.Clinic == clinic_name].Name.unique(),
-        key=lambda x: x.split(" ")[1],
-    )
-
-    current_metric = df[
-        (df["Metric"] == metric)
-        & (df["Date"] == current_date)
-        & (df["Name"].isin(clinic_providers))
-    ]
-    current_metric = current_metric.drop(["Type", "Clinic", "Metric", "Date"], axis=1)
-
-    start_date = min(clinic_df["Date"])
-    start_metric = df[
-        (df["Metric"] == metric)
-        & (df["Date"] == start_date)
-        & (df["Name"].isin(clinic_providers))
-    ]
-    start_metric = start_metric.drop(["Type", "Clinic", "Metric", "Date"], axis=1)
-    start_and_current = pd.concat([start_metric, current_metric])
-
     ranged_dot = (
         alt.Chart(start_and_current)
         .mark_line(color=light_purple)
@@ -324,66 +1153,52 @@ def make_clinic_metric_json(metric, clinic_name, clinic_df, fcn_df):
     )
 
     ranged_dot += (
-        alt.Chart(current_metric)
+        alt.Chart(current)
         .mark_point(size=100, opacity=1, filled=True, color=dark_purple)
         .encode(alt.Y("%:Q"), alt.X("Name:N", sort=clinic_providers))
     )
 
-    ranged_dot_rule = (
-        alt.Chart(metricdf)
-        .mark_rule(strokeWidth=1, strokeDash=[4, 2])
-        .encode(y="TargetValue:Q", color=alt.value(dark_green))
-    )
-
-    if metric_target:
-        chart = (
-            fcn_progress_line
-            + clinic_progress_line
+    if target is not None:
+        metric_target_rule = (
+            alt.Chart(target)
+            .mark_rule(strokeWidth=1, strokeDash=[4, 2])
+            .encode(y="TargetValue:Q", color=alt.ColorValue(dark_green))
+        )
+        metric_target_text = (
+            alt.Chart(target)
+            .mark_text(align="right", baseline="bottom", dx=100, dy=100, size=16)
+            .encode(
+                text=alt.Text("TargetValue:Q", format=".2%"),
+                color=alt.ColorValue(dark_green),
+            )
+        )
+        ranged_dot_rule = (
+            alt.Chart(target)
+            .mark_rule(strokeWidth=1, strokeDash=[4, 2])
+            .encode(y="TargetValue:Q", color=alt.value(dark_green))
+        )
+        chart = (
+            fcn_progress_line
+            + clinic_progress_line
             + metric_target_rule
             + metric_target_text
             + clinic_progress_text
         ) | ranged_dot + ranged_dot_rule
     else:
         chart = (fcn_progress_line + clinic_progress_line) | ranged_dot
-    return chart.to_json()
+    return chart
 
 
-def save_clinic_chart_data(clinic_name):
-    json_data = ""
-    clinic_df = df[(df["Name"] == clinic_name)]
-    clinic_df = clinic_df.drop(["Name", "Type", "Clinic"], axis=1)
-
-    for metric in main_metrics:
-        chart_data = make_clinic_metric_json(metric, clinic_name, clinic_df, fcn_df)
-        chart_data_json = json.loads(chart_data)
-        json_minified = json.dumps(chart_data_json, separators=(",", ":"))
-        json_data += "var " + metric.replace(" ", "_") + " = " + json_minified + ";\n"
-    foldername = savefolder(clinic_name)
-    with open(foldername + "chart_data.json", "w") as savefile:
-        savefile.write(json_data)
-
-
-def make_fcn_metric_json(metric):
+def fcn_chart(fcn, fcn_current, start_and_current, current, target):
     """
-    Makes a chart for a single metric for FCN.
-
-    Assumes: dataframe 'df' that has all the data from CSVs
-    Assumes: dataframes 'names' and 'metrics' for lookups
+    Builds the progress chart and clinic ranged dots for FCN and a metric.
+    Data arguments are dataframes or alt.NamedData; target is None when the
+    metric has no target.
     """
-
-    fcn_df = df[(df["Metric"] == metric) & (df["Type"] == "FCN")]
-    fcn_df = fcn_df.drop(["Name", "Type", "Clinic", "Metric"], axis=1)
-
-    fcn_current_metric = df[
-        (df["Metric"] == metric) & (df["Name"] == "FCN") & (df["Date"] == current_date)
-    ]
-
-    metric_target = metrics[metrics.Metric == metric].iloc[0].Target
-    if metric_target:
-        metricdf = pd.DataFrame([{"TargetValue": metric_target, "Title": "Target"}])
+    import altair as alt
 
     fcn_progress_line = (
-        alt.Chart(fcn_df)
+        alt.Chart(fcn)
         .mark_line(strokeWidth=4)
         .encode(
             alt.X(
@@ -401,41 +1216,11 @@ def make_fcn_metric_json(metric):
         .properties(width=200, height=200)
     )
     fcn_progress_line += (
-        alt.Chart(fcn_current_metric)
+        alt.Chart(fcn_current)
         .mark_text(align="right", baseline="top", dx=100, dy=-98, size=16)
         .encode(text=alt.Text("%:Q", format=".2%"), color=alt.ColorValue(dark_blue))
     )
 
-    if metric_target:
-        metric_target_rule = (
-            alt.Chart(metricdf)
-            .mark_rule(strokeWidth=1, strokeDash=[4, 2])
-            .encode(y="TargetValue:Q", color=alt.ColorValue(dark_green))
-        )
-        metric_target_rule += (
-            alt.Chart(metricdf)
-            .mark_text(align="right", baseline="bottom", dx=100, dy=100, size=16)
-            .encode(
-                text=alt.Text("TargetValue:Q", format=".2%"),
-                color=alt.ColorValue(dark_green),
-            )
-        )
-
-    current_metric = df[
-        (df["Metric"] == metric)
-        & (df["Date"] == current_date)
-        & (df["Type"] == "Clinic")
-    ]
-    current_metric = current_metric.drop(["Type", "Clinic", "Metric", "Date"], axis=1)
-
-    start_date = min(fcn_df["Date"])
-    start_metric = df[
-        (df["Metric"] == metric) & (df["Date"] == start_date) & (df["Type"] == "Clinic")
-    ]
-    start_metric = start_metric.drop(["Type", "Clinic", "Metric", "Date"], axis=1)
-
-    start_and_current = pd.concat([start_metric, current_metric])
-
     ranged_dot = (
         alt.Chart(start_and_current)
         .mark_line(color=light_orange)
@@ -452,215 +1237,2009 @@ def make_fcn_metric_json(metric):
     )
 
     ranged_dot += (
-        alt.Chart(current_metric)
+        alt.Chart(current)
         .mark_point(size=100, opacity=1, filled=True, color=dark_orange)
         .encode(alt.Y("%:Q"), alt.X("Name:N"))
     )
 
-    ranged_dot_rule = (
-        alt.Chart(metricdf)
-        .mark_rule(strokeWidth=1, strokeDash=[4, 2])
-        .encode(y="TargetValue:Q", color=alt.value(dark_green))
-    )
-
-    if metric_target:
+    if target is not None:
+        metric_target_rule = (
+            alt.Chart(target)
+            .mark_rule(strokeWidth=1, strokeDash=[4, 2])
+            .encode(y="TargetValue:Q", color=alt.ColorValue(dark_green))
+        )
+        metric_target_rule += (
+            alt.Chart(target)
+            .mark_text(align="right", baseline="bottom", dx=100, dy=100, size=16)
+            .encode(
+                text=alt.Text("TargetValue:Q", format=".2%"),
+                color=alt.ColorValue(dark_green),
+            )
+        )
+        ranged_dot_rule = (
+            alt.Chart(target)
+            .mark_rule(strokeWidth=1, strokeDash=[4, 2])
+            .encode(y="TargetValue:Q", color=alt.value(dark_green))
+        )
         chart = (metric_target_rule + fcn_progress_line) | ranged_dot + ranged_dot_rule
     else:
         chart = (fcn_progress_line) | ranged_dot
-    return chart.to_json()
+    return chart
 
 
-# In names dataframe, if data in individual column then it's an active person
-single_providers = names[(names["Type"] == "Individual")]
+# Bump when a chart builder changes, so cached specs and renders go stale.
+chart_template_version = 1
+sort_placeholder = "<!--SORT-->"
 
-sorted_single_provider_names = sorted(
-    single_providers.Name.unique(), key=lambda x: x.split(" ")[1]
-)
-clinics = sorted(set(df[(df["Type"] == "Clinic")].Name.unique()))
-main_metrics = sorted(set(metrics[(metrics["Main"] == "Main")].Metric.unique()))
-current_date = max(df["Date"])
-current_date_string = current_date.strftime("%m/%d/%Y")
 
+def find_paths(spec, value, path=()):
+    """
+    Returns the key paths in a spec dict where value appears.
+    """
+    if spec == value:
+        return [path]
+    if isinstance(spec, dict):
+        items = spec.items()
+    elif isinstance(spec, list):
+        items = enumerate(spec)
+    else:
+        return []
+    return [
+        found
+        for key, child in items
+        for found in find_paths(child, value, path + (key,))
+    ]
 
-def savefolder(name):
-    foldername = str(name).replace(" ", "_")
-    if not os.path.exists("./docs/" + foldername):
-        os.makedirs("./docs/" + foldername)
-    return "./docs/" + foldername + "/"
+
+def compile_chart_template(chart):
+    """
+    Converts a chart built on alt.NamedData to a Vega-Lite dict once per run.
+    Entity data is injected later as top-level datasets under the same names.
+    """
+    spec = chart.to_dict()
+    return {"spec": spec, "sort_paths": find_paths(spec, [sort_placeholder])}
+
+
+def named_data(*names):
+    """
+    Returns alt.NamedData placeholders keyed by their dataset names.
+    """
+    import altair as alt
+
+    return {name: alt.NamedData(name=name) for name in names}
 
 
-def create_full_html(provider):
-    with open(
-        "./docs/" + provider.replace(" ", "_") + "/chart_data.json", "r"
-    ) as chart_data:
-        chart_data_text = chart_data.read()
-        new_custom_javascript = custom_javascript.replace(
-            "<!--JSON-->", chart_data_text
+def compile_chart_templates():
+    """
+    Compiles every chart shape, with and without a target.
+    """
+    import altair as alt
+
+    templates = {}
+    for has_target in [True, False]:
+        target = alt.NamedData(name="target") if has_target else None
+        templates[("Individual", has_target)] = compile_chart_template(
+            individual_chart(
+                target=target,
+                **named_data("provider", "provider_current", "clinic", "fcn"),
+            )
         )
-    templateLoader = jinja2.FileSystemLoader(searchpath="./files/")
-    templateEnv = jinja2.Environment(
-        loader=templateLoader,
-        trim_blocks=True,
-        lstrip_blocks=True,
-        line_statement_prefix="#",
+        templates[("Clinic", has_target)] = compile_chart_template(
+            clinic_chart(
+                target=target,
+                clinic_providers=[sort_placeholder],
+                **named_data(
+                    "clinic", "clinic_current", "fcn", "start_and_current", "current"
+                ),
+            )
+        )
+        templates[("FCN", has_target)] = compile_chart_template(
+            fcn_chart(
+                target=target,
+                **named_data("fcn", "fcn_current", "start_and_current", "current"),
+            )
+        )
+    return templates
+
+
+def chart_rows(frame, columns):
+    """
+    Converts frame columns to Vega-Lite rows the same way Altair does.
+    """
+    values = []
+    for column in columns:
+        if column == "Date":
+            values.append([date.isoformat() for date in frame["Date"]])
+        elif column in ["%", "TargetValue"]:
+            values.append(
+                [None if pd.isna(x) else round(float(x), 4) for x in frame[column]]
+            )
+        else:
+            values.append(frame[column].astype(object).tolist())
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def shared_series(name, metric):
+    """
+    References a clinic or FCN series that is written once to its datasets.js
+    instead of being copied into every spec that charts it.
+    """
+    return [name, metric]
+
+
+@functools.lru_cache(maxsize=None)
+def shared_series_rows(name, metric):
+    """
+    Returns the chart rows of a shared series, converted once per process.
+    """
+    return chart_rows(get_series(name, metric), ["Date", "%"])
+
+
+def fill_chart_template(template, datasets, sort=None):
+    """
+    Returns a spec for one entity from a compiled template. Only the dicts on
+    the path to the sort order are copied; the rest is shared with the template.
+    Shared series are listed under usermeta for the page to fill in.
+    """
+    spec = dict(template["spec"])
+    spec["datasets"] = {}
+    spec["usermeta"] = {"shared": {}}
+    for name, data in datasets.items():
+        if isinstance(data, list):
+            spec["usermeta"]["shared"][name] = data
+        elif data is not None:
+            spec["datasets"][name] = chart_rows(data, list(data.columns))
+    for path in template["sort_paths"]:
+        node = spec
+        for key in path[:-1]:
+            node[key] = copy.copy(node[key])
+            node = node[key]
+        node[path[-1]] = sort
+    return spec
+
+
+@functools.lru_cache(maxsize=None)
+def shared_series_digest(name, metric):
+    """
+    Hashes the chart rows of a shared series, once per process.
+    """
+    return hashlib.sha1(
+        dump_json(shared_series_rows(name, metric)).encode()
+    ).hexdigest()
+
+
+def resolve_shared_datasets(chart_data):
+    """
+    Returns a copy of the spec with its shared series filled in, for rendering
+    outside of a page.
+    """
+    datasets = dict(chart_data["datasets"])
+    for name, (shared_name, metric) in chart_data["usermeta"]["shared"].items():
+        datasets[name] = shared_series_rows(shared_name, metric)
+    return dict(chart_data, datasets=datasets)
+
+
+def dump_json(data):
+    """
+    Returns minified JSON, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, separators=(",", ":"))
+
+
+def shared_datasets_script(name):
+    """
+    Returns the datasets.js of a clinic or FCN, with its series for every
+    metric.
+    """
+    script = ["var shared_datasets = shared_datasets || {};\n"]
+    script.append("shared_datasets[" + dump_json(name) + "] = {")
+    for index, metric in enumerate(main_metrics):
+        script.append("," if index else "")
+        script.append(dump_json(metric) + ":")
+        script.append(dump_json(shared_series_rows(name, metric)))
+    script.append("};\n")
+    return "".join(script)
+
+
+def save_shared_datasets(name):
+    """
+    Writes the series of a clinic or FCN for every metric, once, for all the
+    pages that chart it.
+    """
+    with open(savefolder(name) + "datasets.js", "w", encoding="utf-8") as savefile:
+        savefile.write(shared_datasets_script(name))
+
+
+def chart_data_script(chart_specs):
+    """
+    Returns the page javascript that defines a variable for each metric's
+    spec, then fills in their shared series.
+    """
+    variables = []
+    script = []
+    for metric, chart_data in chart_specs:
+        variables.append(metric.replace(" ", "_"))
+        script.append("var " + variables[-1] + " = " + dump_json(chart_data) + ";\n")
+    script.append("[" + ", ".join(variables) + "].forEach(resolveSharedData);\n")
+    return "".join(script)
+
+
+def metric_target_data(metric):
+    """
+    Returns the target for a metric as chart data, or None without a target.
+    Assumes: dataframe 'metrics' for lookups
+    """
+    metric_target = metrics[metrics.Metric == metric].iloc[0].Target
+    if metric_target:
+        return pd.DataFrame([{"TargetValue": metric_target, "Title": "Target"}])
+    return None
+
+
+def individual_metric_data(metric, name, clinic_name):
+    """
+    Collects the chart data for a single metric and a single provider.
+    Assumes: series index 'series_index' for the provider, clinic and FCN data
+    """
+    provider_df = get_series(name, metric)[["Date", "%"]]
+    return {
+        "provider": provider_df,
+        "provider_current": provider_df[provider_df["Date"] == current_date][["%"]],
+        "clinic": shared_series(clinic_name, metric),
+        "fcn": shared_series("FCN", metric),
+        "target": metric_target_data(metric),
+    }
+
+
+def make_individual_metric_json(metric, name, clinic_name):
+    """
+    Makes a chart json for a single metric and a single provider.
+    Assumes: compiled templates 'chart_templates'
+    """
+    return cached_chart("Individual", individual_metric_data(metric, name, clinic_name))
+
+
+def save_individual_chart_data(name):
+    clinic_name = names[names.Name == name].iloc[0].Clinic
+
+    chart_specs = (
+        (metric, make_individual_metric_json(metric, name, clinic_name))
+        for metric in main_metrics
     )
-    TEMPLATE_FILE = "index.html"
-    template = templateEnv.get_template(TEMPLATE_FILE)
-    template_weasy = templateEnv.get_template("index-weasy.html")
-    providertype = names[names.Name == provider].iloc[0].Type
-    clinic_name = names[names.Name == provider].iloc[0].Clinic
-    same_clinic_providers = sorted(
+    return chart_data_script(chart_specs)
+
+
+def save_individual_svgs(name):
+    """
+    Renders a provider's charts to SVG for the PDF. The specs come from the
+    chart cache, filled when the provider's chart data was saved.
+    """
+    clinic_name = names[names.Name == name].iloc[0].Clinic
+    foldername = savefolder(name)
+    for metric in selected_metrics or main_metrics:
+        _, seconds, _ = timed(
+            cached_svg,
+            "Individual",
+            individual_metric_data(metric, name, clinic_name),
+            foldername + metric + ".svg",
+        )
+        metric_seconds[metric] = metric_seconds.get(metric, 0) + seconds
+
+
+def clinic_providers_for(clinic_name):
+    """
+    Returns the providers of a clinic, sorted by last name.
+    """
+    return sorted(
         single_providers[single_providers.Clinic == clinic_name].Name.unique(),
         key=lambda x: x.split(" ")[1],
     )
-    filedata = template.render(
-        current_date_string=current_date_string,
-        new_custom_javascript=new_custom_javascript,
-        providertype=providertype,
-        provider=provider,
-        clinic_name=clinic_name,
-        same_clinic_providers=same_clinic_providers,
-        clinics=clinics,
+
+
+def clinic_metric_data(metric, clinic_name):
+    """
+    Collects the chart data for a single metric and a clinic.
+    Assumes: series index 'series_index' and snapshot table 'snapshot_table'
+    """
+    clinic_df = get_series(clinic_name, metric)[["Date", "%"]]
+    start_and_current = get_start_and_current(clinic_name, metric)
+    return {
+        "clinic": shared_series(clinic_name, metric),
+        "clinic_current": clinic_df[clinic_df["Date"] == current_date][["%"]],
+        "fcn": shared_series("FCN", metric),
+        "start_and_current": start_and_current[["Name", "%"]],
+        "current": start_and_current[(start_and_current["Snapshot"] == "Current")][
+            ["Name", "%"]
+        ],
+        "target": metric_target_data(metric),
+    }
+
+
+def make_clinic_metric_json(metric, clinic_name):
+    """
+    Makes a chart for a single metric and a clinic.
+    Assumes: compiled templates 'chart_templates'
+    """
+    return cached_chart(
+        "Clinic",
+        clinic_metric_data(metric, clinic_name),
+        sort=clinic_providers_for(clinic_name),
     )
-    with open(savefolder(provider) + "index.html", "w+") as file:
-        file.write(filedata)
 
-    filedata_weasy = template_weasy.render(
-        current_date_string=current_date_string,
-        provider=provider,
-        clinic_name=clinic_name,
+
+def clinic_chart_data(clinic_name):
+    chart_specs = (
+        (metric, make_clinic_metric_json(metric, clinic_name))
+        for metric in main_metrics
     )
-    with open(savefolder(provider) + "index-weasy.html", "w+") as file:
-        file.write(filedata_weasy)
+    return chart_data_script(chart_specs)
+
+
+def save_clinic_chart_data(clinic_name):
+    save_shared_datasets(clinic_name)
+    return clinic_chart_data(clinic_name)
+
+
+def fcn_metric_data(metric):
+    """
+    Collects the chart data for a single metric for FCN.
+    Assumes: series index 'series_index' and snapshot table 'snapshot_table'
+    """
+    fcn_df = get_series("FCN", metric)[["Date", "%"]]
+    start_and_current = get_start_and_current("FCN", metric)
+    return {
+        "fcn": shared_series("FCN", metric),
+        "fcn_current": fcn_df[fcn_df["Date"] == current_date][["%"]],
+        "start_and_current": start_and_current[["Name", "%"]],
+        "current": start_and_current[(start_and_current["Snapshot"] == "Current")][
+            ["Name", "%"]
+        ],
+        "target": metric_target_data(metric),
+    }
 
 
-FCN_logo = "./files/pictures/logo.png"
-if os.path.isfile(FCN_logo):
-    if not os.path.exists("./docs/pictures/"):
-        os.makedirs("./docs/pictures/")
-    shutil.copyfile(FCN_logo, "./docs/pictures/logo.png")
+def make_fcn_metric_json(metric):
+    """
+    Makes a chart for a single metric for FCN.
+    Assumes: compiled templates 'chart_templates'
+    """
+    return cached_chart("FCN", fcn_metric_data(metric))
 
-if not os.path.exists("./docs/js/"):
-    os.makedirs("./docs/js/")
-files = glob.glob("./files/js/*.js")
-for file in files:
-    _, tail = os.path.split(file)
-    shutil.copyfile(file, "./docs/js/" + str(tail))
 
-css = "./files/uikit.min.css"
-if os.path.isfile(css):
-    shutil.copyfile(css, "./docs/uikit.min.css")
+def fcn_chart_data(name):
+    chart_specs = ((metric, make_fcn_metric_json(metric)) for metric in main_metrics)
+    return chart_data_script(chart_specs)
 
-favicon = "./files/pictures/favicon.ico"
-if os.path.isfile(favicon):
-    shutil.copyfile(favicon, "./docs/favicon.ico")
 
-comet_chart = "./files/pictures/quality_comet.png"
-if os.path.isfile(comet_chart):
-    shutil.copyfile(comet_chart, "./docs/quality_comet.png")
+def save_fcn_chart_data(name):
+    save_shared_datasets(name)
+    return fcn_chart_data(name)
 
 
-fcn_df = df[(df["Name"] == "FCN")]
-fcn_df = fcn_df.drop(["Name", "Type", "Clinic"], axis=1)
+# Each process keeps one renderer for all of its charts: vl-convert in process
+# when it is installed, otherwise a headless browser started on first use.
+svg_renderer = {"backend": None, "driver": None, "render_seconds": [], "restarts": 0}
 
-if create_graphs:
-    pool = Pool()
-    for _ in tqdm.tqdm(
-        pool.imap(save_individual_chart_data, sorted_single_provider_names),
-        total=len(sorted_single_provider_names),
-        desc="   Graphs",
-    ):
-        pass
-    pool.close()
-    pool.join()
 
-if create_graphs:
-    pool2 = Pool()
-    for _ in tqdm.tqdm(
-        pool2.imap(save_clinic_chart_data, clinics),
-        total=len(clinics),
-        desc="   Graphs",
-    ):
-        pass
-    pool2.close()
-    pool2.join()
+def start_svg_driver():
+    """
+    Starts a headless Firefox with the pinned Vega and Vega-Lite builds in
+    ./files/js/svg-renderer/ loaded, ready for specs. Nothing is fetched from
+    the network, so renders only change when those files do.
+    """
+    from selenium import webdriver
 
+    options = webdriver.FirefoxOptions()
+    options.add_argument("--headless")
+    driver = webdriver.Firefox(options=options)
+    driver.set_script_timeout(60)
+    driver.get("file://" + os.path.abspath("./files/svg-renderer.html"))
+    return driver
 
-if create_graphs:
-    json_data = ""
-    name = "FCN"
-    for metric in main_metrics:
-        chart_data = make_fcn_metric_json(metric)
-        chart_data_json = json.loads(chart_data)
-        json_minified = json.dumps(chart_data_json, separators=(",", ":"))
-        json_data += "var " + metric.replace(" ", "_") + " = " + json_minified + ";\n"
-    foldername = savefolder(name)
-    with open(foldername + "chart_data.json", "w") as savefile:
-        savefile.write(json_data)
 
-with open("./files/js/jkp_custom.js", "r") as customjs:
-    custom_javascript = customjs.read()
+def stop_svg_driver():
+    if svg_renderer["driver"] is not None:
+        svg_renderer["driver"].quit()
+        svg_renderer["driver"] = None
+
+
+def start_svg_renderer():
+    """
+    Picks the renderer for this process. The browser is closed when the
+    process exits, so pool workers keep theirs across tasks.
+    """
+    if vl_convert_installed:
+        svg_renderer["backend"] = "vl-convert"
+        return
+    svg_renderer["backend"] = "firefox"
+    svg_renderer["driver"] = start_svg_driver()
+    multiprocessing.util.Finalize(None, stop_svg_driver, exitpriority=10)
+
+
+def vl_convert_vegalite_version():
+    """
+    Returns Altair's Vega-Lite version, or the oldest one vl-convert bundles.
+    """
+    import altair as alt
+    import vl_convert
+
+    vl_version = ".".join(alt.VEGALITE_VERSION.split(".")[:2])
+    if vl_version not in vl_convert.get_vegalite_versions():
+        vl_version = vl_convert.get_vegalite_versions()[0]
+    return vl_version
+
+
+def svg_renderer_files():
+    """
+    Returns the browser renderer's page and the Vega builds it loads.
+    """
+    return ["./files/svg-renderer.html"] + sorted(
+        glob.glob("./files/js/svg-renderer/*.js")
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def svg_renderer_fingerprint():
+    """
+    Identifies what SVGs are drawn with, for their cache key: the vl-convert
+    and Vega-Lite versions, or a hash of the browser renderer's files.
+    """
+    if vl_convert_installed:
+        import vl_convert
+
+        renderer = "vl-convert {} vega-lite {}".format(
+            vl_convert.__version__, vl_convert_vegalite_version()
+        ).encode()
+    else:
+        renderer = b"firefox"
+        for renderer_file in svg_renderer_files():
+            with open(renderer_file, "rb") as rendererfile:
+                renderer += rendererfile.read()
+    return hashlib.sha1(renderer).hexdigest()[:16]
+
 
-for provider in sorted_single_provider_names:
-    provider_picture = "./files/pictures/" + str(provider).replace(" ", "_") + ".JPG"
-    if os.path.isfile(provider_picture):
-        shutil.copyfile(
-            provider_picture,
-            "./docs/pictures/" + str(provider).replace(" ", "_") + ".JPG",
+def render_svg(chart_data):
+    """
+    Renders a Vega-Lite spec dict to SVG text, restarting the browser once if
+    it has died.
+    """
+    if svg_renderer["backend"] is None:
+        start_svg_renderer()
+    start_time = time.time()
+    if svg_renderer["backend"] == "vl-convert":
+        import vl_convert
+
+        svg = vl_convert.vegalite_to_svg(
+            vl_spec=chart_data, vl_version=vl_convert_vegalite_version()
         )
     else:
-        print("Missing photo:", provider_picture)
-if create_htmls:
-    all_individual_clinic_fcn = names[
-        (names["Type"].isin(["Individual", "Clinic", "FCN"]))
-    ].Name.unique()
-    for provider in all_individual_clinic_fcn:
-        create_full_html(provider)
-
-
-
-templateLoader = jinja2.FileSystemLoader(searchpath="./files/")
-templateEnv = jinja2.Environment(
-    loader=templateLoader,
-    trim_blocks=True,
-    lstrip_blocks=True,
-    line_statement_prefix="#",
-)
-template_base = templateEnv.get_template("index-base.html")
-filedata = template_base.render(
-names=names, sorted_single_provider_names=sorted_single_provider_names, current_date_string=current_date_string, clinics=clinics
-)
-with open("./docs/index.html", "w+") as file:
-    file.write(filedata)
+        from selenium.common.exceptions import WebDriverException
+
+        script = "renderSvg(arguments[0], arguments[1]);"
+        try:
+            svg = svg_renderer["driver"].execute_async_script(script, chart_data)
+        except WebDriverException:
+            stop_svg_driver()
+            svg_renderer["driver"] = start_svg_driver()
+            svg_renderer["restarts"] += 1
+            svg = svg_renderer["driver"].execute_async_script(script, chart_data)
+        if isinstance(svg, dict):
+            raise ValueError("SVG render failed: " + svg["error"])
+    svg_renderer["render_seconds"].append(time.time() - start_time)
+    return svg
+
+
+# Charts are cached under a hash of everything they are drawn from, so a
+# chart whose data hasn't changed since the last build is never rebuilt.
+chart_cache = {"hits": 0, "misses": 0}
+# Seconds spent on each metric's SVGs in this process, for the timing report.
+metric_seconds = {}
+
+
+def chart_cache_key(shape, datasets, sort=None):
+    """
+    Hashes a chart's data, target, sort order, date domain and template version.
+    """
+    inputs = {}
+    for name, data in datasets.items():
+        if isinstance(data, list):
+            inputs[name] = [data, shared_series_digest(*data)]
+        elif data is not None:
+            inputs[name] = chart_rows(data, list(data.columns))
+    key_data = [
+        chart_template_version,
+        graphing_start_date,
+        graphing_end_date,
+        shape,
+        inputs,
+        sort,
+    ]
+    return hashlib.sha1(dump_json(key_data).encode()).hexdigest()
 
 
-def pdf_folder(name):
-    foldername = str(name).replace(" ", "_")
-    if not os.path.exists("./docs/" + foldername):
-        os.makedirs("./docs/" + foldername)
-    return "/docs/" + foldername + "/"
+def write_cache_file(cachefile, text):
+    """
+    Writes a cache entry atomically, since workers may race on the same key.
+    """
+    if not os.path.exists(os.path.dirname(cachefile)):
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    tempfile = cachefile + "." + str(os.getpid()) + ".tmp"
+    with open(tempfile, "w", encoding="utf-8") as savefile:
+        savefile.write(text)
+    os.replace(tempfile, cachefile)
+
 
+def chart_cache_file(shape, datasets, sort=None):
+    """
+    Returns the cache path of a chart, without an extension.
+    """
+    return cache_folder + "charts/" + chart_cache_key(shape, datasets, sort)
 
-def make_pdf(provider):
-    HTML(
-        "http://0.0.0.0:8000{}index-weasy.html".format(pdf_folder(provider))
-    ).write_pdf(target=".{}{}.pdf".format(pdf_folder(provider), provider))
 
+def load_chart_spec(cachefile, shape, datasets, sort=None):
+    """
+    Returns a chart's spec from the cache, or fills the template and caches it.
+    Assumes: compiled templates 'chart_templates'
+    """
+    if os.path.isfile(cachefile + ".json"):
+        with open(cachefile + ".json", "r", encoding="utf-8") as specfile:
+            chart_data = json.load(specfile)
+        os.utime(cachefile + ".json")
+        return chart_data, True
+    chart_data = fill_chart_template(
+        chart_templates[(shape, datasets["target"] is not None)], datasets, sort
+    )
+    write_cache_file(cachefile + ".json", dump_json(chart_data))
+    return chart_data, False
 
-if create_pdfs:
-    pool = Pool()
-    for _ in tqdm.tqdm(
-        pool.imap(make_pdf, single_providers.Name.unique()),
-        total=len(single_providers),
-        desc="     PDFs",
-    ):
-        pass
-    pool.close()
-    pool.join()
+
+def cached_chart(shape, datasets, sort=None):
+    """
+    Returns the spec of a chart, filling the template only when the chart
+    isn't in the cache.
+    """
+    cachefile = chart_cache_file(shape, datasets, sort)
+    chart_data, hit = load_chart_spec(cachefile, shape, datasets, sort)
+    chart_cache["hits" if hit else "misses"] += 1
+    return chart_data
+
+
+def cached_svg_file(shape, datasets):
+    """
+    Returns the cache file of a chart's SVG, rendering it only when it isn't
+    in the cache. SVGs are keyed by the renderer too, so switching backends or
+    editing the renderer draws them again.
+    """
+    cachefile = chart_cache_file(shape, datasets)
+    svgfile = cachefile + "-" + svg_renderer_fingerprint() + ".svg"
+    if os.path.isfile(svgfile):
+        os.utime(svgfile)
+        chart_cache["hits"] += 1
+    else:
+        chart_data, _ = load_chart_spec(cachefile, shape, datasets)
+        svg = render_svg(resolve_shared_datasets(chart_data))
+        write_cache_file(svgfile, svg)
+        chart_cache["misses"] += 1
+    return svgfile
+
+
+def cached_svg(shape, datasets, svg_filename):
+    """
+    Copies the SVG of a chart to svg_filename, from the cache when it can.
+    """
+    shutil.copyfile(cached_svg_file(shape, datasets), svg_filename)
+
+
+def prune_chart_cache():
+    """
+    Evicts the least recently used charts until the cache fits its limit.
+    """
+    entries = []
+    for cachefile in glob.glob(cache_folder + "charts/*"):
+        stat = os.stat(cachefile)
+        entries.append((stat.st_mtime, stat.st_size, cachefile))
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, cachefile in sorted(entries):
+        if cache_size <= chart_cache_limit:
+            break
+        os.remove(cachefile)
+        cache_size -= size
+    return cache_size
+
+
+def collect_task_stats():
+    """
+    Returns and resets this process's render timings, restarts, chart cache
+    hits and PDF pages.
+    """
+    stats = {
+        "backend": svg_renderer["backend"],
+        "render_seconds": svg_renderer["render_seconds"],
+        "restarts": svg_renderer["restarts"],
+        "hits": chart_cache["hits"],
+        "misses": chart_cache["misses"],
+        "pdf_pages": pdf_engine["pages"],
+        "pdf_seconds": pdf_engine["seconds"],
+        "metric_seconds": dict(metric_seconds),
+    }
+    metric_seconds.clear()
+    svg_renderer["render_seconds"] = []
+    svg_renderer["restarts"] = 0
+    chart_cache["hits"] = 0
+    chart_cache["misses"] = 0
+    pdf_engine["pages"] = 0
+    pdf_engine["seconds"] = 0.0
+    return stats
+
+
+def report_pdf_stats(stats_list):
+    """
+    Prints PDF pages rendered and pages per second of worker time.
+    """
+    pages = sum(stats["pdf_pages"] for stats in stats_list)
+    seconds = sum(stats["pdf_seconds"] for stats in stats_list)
+    if not pages:
+        return
+    print(
+        "PDFs: {} pages in {:.1f}s of worker time ({:.1f} pages/sec)".format(
+            pages, seconds, pages / seconds if seconds else 0
+        )
+    )
+
+
+def report_chart_cache(stats_list):
+    """
+    Prints chart cache hits across workers and the cache size after eviction.
+    """
+    print(
+        "Chart cache: {} hits, {} misses, {:.1f} MB".format(
+            sum(stats["hits"] for stats in stats_list),
+            sum(stats["misses"] for stats in stats_list),
+            prune_chart_cache() / 1024 / 1024,
+        )
+    )
+
+
+def report_svg_stats(stats_list):
+    """
+    Prints per chart render latency and renderer restarts across workers.
+    """
+    render_seconds = sorted(
+        seconds for stats in stats_list for seconds in stats["render_seconds"]
+    )
+    if not render_seconds:
+        return
+    print(
+        "SVGs: {} rendered with {}, {:.0f} ms mean, {:.0f} ms p95, "
+        "{} renderer restarts".format(
+            len(render_seconds),
+            ", ".join(sorted(set(stats["backend"] for stats in stats_list) - {None})),
+            1000 * sum(render_seconds) / len(render_seconds),
+            1000 * render_seconds[int(0.95 * (len(render_seconds) - 1))],
+            sum(stats["restarts"] for stats in stats_list),
+        )
+    )
+
+
+def benchmark_charts():
+    """
+    Times building every chart with the Altair API against filling the
+    compiled templates, on the current data set.
+    """
+    builds = []
+    for name in sorted_single_provider_names:
+        clinic_name = names[names.Name == name].iloc[0].Clinic
+        for metric in main_metrics:
+            datasets = individual_metric_data(metric, name, clinic_name)
+            builds.append(("Individual", individual_chart, datasets, {}))
+    for clinic_name in clinics:
+        sort = {"clinic_providers": clinic_providers_for(clinic_name)}
+        for metric in main_metrics:
+            datasets = clinic_metric_data(metric, clinic_name)
+            builds.append(("Clinic", clinic_chart, datasets, sort))
+    for metric in main_metrics:
+        builds.append(("FCN", fcn_chart, fcn_metric_data(metric), {}))
+
+    start_time = time.time()
+    for _, chart_builder, datasets, sort in builds:
+        frames = {
+            name: get_series(*data)[["Date", "%"]] if isinstance(data, list) else data
+            for name, data in datasets.items()
+        }
+        chart_builder(**frames, **sort).to_dict()
+    altair_seconds = time.time() - start_time
+
+    start_time = time.time()
+    for entity_type, _, datasets, sort in builds:
+        fill_chart_template(
+            chart_templates[(entity_type, datasets["target"] is not None)],
+            datasets,
+            sort=sort.get("clinic_providers"),
+        )
+    template_seconds = time.time() - start_time
+
+    print(
+        "Charts: {} built, Altair {:.1f} charts/sec, templates {:.1f} charts/sec".format(
+            len(builds), len(builds) / altair_seconds, len(builds) / template_seconds
+        )
+    )
+
+
+def benchmark_startup():
+    """
+    Times a bare interpreter, importing this module, and importing it and
+    loading the dataset, each in a fresh process.
+    """
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    for step, code in [
+        ("interpreter", "pass"),
+        ("import", "import {0}"),
+        ("load_dataset", "import {0}; {0}.load_dataset()"),
+    ]:
+        start_time = time.time()
+        subprocess.run(
+            [sys.executable, "-c", code.format(module)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        startup_seconds[step] = round(time.time() - start_time, 3)
+    print(
+        "Startup: interpreter {interpreter:.2f}s, import {import:.2f}s, "
+        "dataset loaded {load_dataset:.2f}s".format(**startup_seconds)
+    )
+
+
+def benchmark_serialization():
+    """
+    Times minifying every clinic and FCN spec with the json module and, when
+    it is installed, orjson.
+    """
+    chart_specs = [
+        make_clinic_metric_json(metric, clinic_name)
+        for clinic_name in clinics
+        for metric in main_metrics
+    ]
+    chart_specs += [make_fcn_metric_json(metric) for metric in main_metrics]
+    encoders = [("json", lambda data: json.dumps(data, separators=(",", ":")))]
+    if orjson is not None:
+        encoders.append(("orjson", dump_json))
+    for encoder_name, encoder in encoders:
+        start_time = time.time()
+        total_bytes = sum(len(encoder(chart_data)) for chart_data in chart_specs)
+        elapsed = time.time() - start_time
+        print(
+            "Serialization: {} specs, {:.0f} KB, {} {:.1f} MB/sec".format(
+                len(chart_specs),
+                total_bytes / 1024,
+                encoder_name,
+                total_bytes / elapsed / 1024**2,
+            )
+        )
+
+
+# In names dataframe, if data in individual column then it's an active person
+single_providers = names[(names["Type"] == "Individual")]
+
+sorted_single_provider_names = sorted(
+    single_providers.Name.unique(), key=lambda x: x.split(" ")[1]
+)
+main_metrics = sorted(set(metrics[(metrics["Main"] == "Main")].Metric.unique()))
+empty_snapshot = pd.DataFrame(columns=["Name", "%", "Snapshot"])
+
+
+def prepare_build():
+    """
+    Loads and publishes the dataset, and builds the lookups every build
+    task reads. They are module globals, handed to pool workers by
+    start_worker.
+    """
+    global df, dataset_layout, series_index, empty_series, clinics, current_date
+    global current_date_string, snapshot_table
+    with timed_stage("publish dataset") as stage:
+        dataset_layout = publish_dataset(load_dataset())
+        df = map_dataset(dataset_layout)
+        stage["items"] = len(dataset_layout["columns"])
+    with timed_stage("series index") as stage:
+        series_index = build_series_index(df)
+        stage["items"] = len(series_index)
+    empty_series = df.iloc[:0]
+    clinics = sorted(set(df[(df["Type"] == "Clinic")].Name.unique()))
+    current_date = max(df["Date"])
+    current_date_string = current_date.strftime("%m/%d/%Y")
+    with timed_stage("snapshots") as stage:
+        # Built from the dataset in report order, which the snapshot rows keep.
+        snapshot_table = build_snapshot_table(load_dataset())
+        stage["items"] = len(snapshot_table)
+
+
+def prepare_chart_templates():
+    """
+    Compiles the chart templates for the tasks and requests that fill in
+    specs. They don't depend on the data, so this runs once per process.
+    """
+    global chart_templates
+    with timed_stage("chart templates") as stage:
+        chart_templates = compile_chart_templates()
+        stage["items"] = len(chart_templates)
+
+
+# Module globals a pool worker needs from the main process. Forked workers
+# would inherit them, but spawned ones import this module fresh.
+worker_globals = [
+    "create_graphs",
+    "create_svgs",
+    "create_htmls",
+    "create_pdfs",
+    "create_packets",
+    "selected_metrics",
+    "dataset_layout",
+    "series_index",
+    "clinics",
+    "current_date",
+    "current_date_string",
+    "snapshot_table",
+    "chart_templates",
+    "custom_javascript",
+]
+
+
+def worker_state():
+    return {name: globals()[name] for name in worker_globals if name in globals()}
+
+
+def start_worker(state):
+    """
+    Sets up a pool worker with the main process's settings and lookups. The
+    dataset is mapped from its published files rather than copied, so the
+    workers share one copy of it in the page cache under any start method.
+    """
+    global df, empty_series, page_templates
+    globals().update(state)
+    df = map_dataset(dataset_layout)
+    empty_series = df.iloc[:0]
+    get_series.cache_clear()
+    page_templates = load_page_templates()
+
+
+def check_selection():
+    for kind, selected, known in [
+        ("provider", selected_providers, sorted_single_provider_names),
+        ("clinic", selected_clinics, clinics),
+        ("metric", selected_metrics, main_metrics),
+    ]:
+        for name in selected:
+            if name not in known:
+                raise ValueError("Unknown {} {!r}".format(kind, name))
+
+
+def savefolder(name):
+    foldername = str(name).replace(" ", "_")
+    if not os.path.exists("./docs/" + foldername):
+        os.makedirs("./docs/" + foldername)
+    return "./docs/" + foldername + "/"
+
+
+def load_page_templates():
+    """
+    Compiles the page templates, once in each process that renders pages:
+    the main process for the preview server and each pool worker as
+    start_worker sets it up. Their bytecode is cached across runs, so only
+    the first process after an edit parses them.
+    """
+    if not os.path.exists(cache_folder + "jinja/"):
+        os.makedirs(cache_folder + "jinja/")
+    templateEnv = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(searchpath="./files/"),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(cache_folder + "jinja/"),
+        trim_blocks=True,
+        lstrip_blocks=True,
+        line_statement_prefix="#",
+    )
+    return {
+        template_name: templateEnv.get_template(template_name)
+        for template_name in ["index.html", "index-weasy.html", "index-base.html"]
+    }
+
+
+def full_html_context(provider, chart_data):
+    """
+    Returns the template variables of a provider's page, with its chart data
+    spliced into the page javascript.
+    """
+    new_custom_javascript = custom_javascript.replace("<!--JSON-->", chart_data)
+    providertype = names[names.Name == provider].iloc[0].Type
+    clinic_name = names[names.Name == provider].iloc[0].Clinic
+    same_clinic_providers = sorted(
+        single_providers[single_providers.Clinic == clinic_name].Name.unique(),
+        key=lambda x: x.split(" ")[1],
+    )
+    # Pages load the clinic and FCN series their specs reference.
+    shared_datasets = sorted(set([clinic_name, "FCN"]))
+    return {
+        "current_date_string": current_date_string,
+        "new_custom_javascript": new_custom_javascript,
+        "providertype": providertype,
+        "provider": provider,
+        "clinic_name": clinic_name,
+        "same_clinic_providers": same_clinic_providers,
+        "clinics": clinics,
+        "shared_datasets": shared_datasets,
+    }
+
+
+def weasy_html(provider):
+    """
+    Renders a provider's page for the PDF.
+    """
+    return page_templates["index-weasy.html"].render(
+        current_date_string=current_date_string,
+        provider=provider,
+        clinic_name=names[names.Name == provider].iloc[0].Clinic,
+    )
+
+
+def create_full_html(provider, chart_data):
+    """
+    Writes a provider's page, and returns the page for the PDF.
+    """
+    page_templates["index.html"].stream(**full_html_context(provider, chart_data)).dump(
+        savefolder(provider) + "index.html", encoding="utf-8"
+    )
+    return weasy_html(provider)
+
+
+def base_html_context():
+    return {
+        "names": names,
+        "sorted_single_provider_names": sorted_single_provider_names,
+        "current_date_string": current_date_string,
+        "clinics": clinics,
+    }
+
+
+def create_base_html(template_name):
+    """
+    Renders the landing page that links every provider and clinic.
+    """
+    page_templates[template_name].stream(**base_html_context()).dump(
+        "./docs/index.html", encoding="utf-8"
+    )
+
+
+def pdf_folder(name):
+    foldername = str(name).replace(" ", "_")
+    if not os.path.exists("./docs/" + foldername):
+        os.makedirs("./docs/" + foldername)
+    return "/docs/" + foldername + "/"
+
+
+# Each process parses the PDF stylesheet and sets up fonts once, on first use,
+# and keeps them for all of its documents. The preview server parses them
+# again when a stylesheet is edited.
+pdf_engine = {
+    "font_config": None,
+    "url_fetcher": None,
+    "stylesheets": None,
+    "pages": 0,
+    "seconds": 0.0,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def read_resource(filename):
+    with open(filename, "rb") as resourcefile:
+        return resourcefile.read()
+
+
+def pdf_resource_file(filename):
+    """
+    Returns the file to read for a resource of a provider's PDF. A chart in
+    the provider's folder of ./docs is read from the chart cache instead,
+    rendered first if it isn't there, so PDFs don't need ./docs to hold the
+    SVGs of every provider they lay out.
+    """
+    folder, svg_name = os.path.split(filename)
+    if os.path.dirname(folder) != os.path.abspath("./docs"):
+        return filename
+    name = entities_by_folder().get(os.path.basename(folder))
+    metric = svg_name[:-4]
+    if name not in sorted_single_provider_names or svg_name != metric + ".svg":
+        return filename
+    if metric not in main_metrics:
+        return filename
+    clinic_name = names[names.Name == name].iloc[0].Clinic
+    return cached_svg_file(
+        "Individual", individual_metric_data(metric, name, clinic_name)
+    )
+
+
+def resource_fetcher():
+    """
+    Returns a fetcher that serves local charts, images and fonts to WeasyPrint
+    from memory, so each process reads a shared file once. Charts come from
+    the chart cache. Other URLs are fetched as usual.
+    """
+    from weasyprint.urls import URLFetcher, URLFetcherResponse
+
+    class ResourceFetcher(URLFetcher):
+        def fetch(self, url, headers=None):
+            if not url.startswith("file://"):
+                return super().fetch(url, headers)
+            filename = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+            filename = pdf_resource_file(filename)
+            return URLFetcherResponse(
+                url,
+                read_resource(filename),
+                {"Content-Type": mimetypes.guess_type(filename)[0] or ""},
+            )
+
+    return ResourceFetcher()
+
+
+def start_pdf_engine():
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    pdf_engine["font_config"] = FontConfiguration()
+    pdf_engine["url_fetcher"] = resource_fetcher()
+    pdf_engine["stylesheets"] = [
+        CSS(
+            filename="./files/index-weasy.css",
+            font_config=pdf_engine["font_config"],
+            url_fetcher=pdf_engine["url_fetcher"],
+        )
+    ]
+
+
+def render_pdf(provider, weasy_html):
+    """
+    Lays out a provider's PDF in process. The page's links are relative to
+    the provider's folder in ./docs, and its charts come from the chart cache.
+    """
+    from weasyprint import HTML
+
+    if pdf_engine["font_config"] is None:
+        start_pdf_engine()
+    foldername = str(provider).replace(" ", "_")
+    document = HTML(
+        string=weasy_html,
+        base_url="file://" + os.path.abspath("./docs/" + foldername) + "/",
+        url_fetcher=pdf_engine["url_fetcher"],
+    ).render(
+        stylesheets=pdf_engine["stylesheets"], font_config=pdf_engine["font_config"]
+    )
+    pdf_engine["pages"] += len(document.pages)
+    return document
+
+
+def pdf_filename(name):
+    return ".{}{}.pdf".format(pdf_folder(name), name)
+
+
+def pdf_clinics():
+    return sorted(single_providers.Clinic.unique())
+
+
+def make_pdf(clinic_name, *weasy_htmls):
+    """
+    Writes the PDF of each provider in a clinic, then the clinic's packet
+    from the same laid out pages.
+    Assumes: weasy_htmls in clinic_providers_for order
+    """
+    start_time = time.time()
+    documents = []
+    for provider, weasy_html in zip(clinic_providers_for(clinic_name), weasy_htmls):
+        documents.append(render_pdf(provider, weasy_html))
+        documents[-1].write_pdf(target=pdf_filename(provider))
+    if create_packets:
+        pages = [page for document in documents for page in document.pages]
+        documents[0].copy(pages).write_pdf(target=pdf_filename(clinic_name))
+    pdf_engine["seconds"] += time.time() - start_time
+
+
+def make_fcn_packet(name):
+    """
+    Joins the clinic packets into one for the whole network, without laying
+    out the pages again.
+    """
+    import pypdf
+
+    writer = pypdf.PdfWriter()
+    for clinic_name in pdf_clinics():
+        writer.append(pdf_filename(clinic_name))
+    writer.write(pdf_filename(name))
+
+
+# Build tasks by stage, with their rough relative cost.
+# Ready tasks with the most work still chained after them are started first.
+task_costs = {"charts": 1, "svgs": 4, "html": 1, "pdf": 8}
+# Payloads handed from one task to the next are kept in memory up to this many
+# characters. Past it they are spilled to disk until the task that needs them.
+payload_memory_limit = 128 * 1024 * 1024
+payload_store = {"memory": {}, "size": 0, "spilled": 0, "limit": payload_memory_limit}
+
+
+def entity_closure(providers, clinic_names):
+    """
+    Returns the providers and clinics, the clinics of those providers, and
+    FCN: every entity whose pages show them.
+    """
+    closure = set(providers) | set(clinic_names)
+    closure |= set(single_providers[single_providers.Name.isin(providers)].Clinic)
+    closure.add("FCN")
+    return closure
+
+
+def redrawn_entities(affected):
+    """
+    Returns every entity that shows the affected providers, clinics or FCN:
+    a clinic's line is drawn on its providers' charts, and each entity is
+    shown on its clinic's and FCN's pages. None when FCN is affected, since
+    its line is drawn on every chart.
+    """
+    if "FCN" in affected:
+        return None
+    clinic_names = set(affected) & set(names[(names["Type"] == "Clinic")].Name)
+    providers = set(affected) & set(sorted_single_provider_names)
+    providers |= set(single_providers[single_providers.Clinic.isin(clinic_names)].Name)
+    return entity_closure(providers, clinic_names)
+
+
+def selected_names():
+    """
+    Returns the entities a partial rebuild covers: the selected providers and
+    clinics, the clinics of those providers, and FCN. None when nothing is
+    selected.
+    """
+    if not (selected_providers or selected_clinics):
+        return None
+    return entity_closure(selected_providers, selected_clinics)
+
+
+def selected_tasks(tasks, selection):
+    """
+    Keeps the tasks of the selected entities and the tasks whose results
+    they are passed. A clinic packet lays out all its providers' pages, so
+    their pages are rebuilt too, but their charts come from the chart cache
+    and the other clinics' packets are read from the last build, where it
+    left them.
+    """
+    wanted = [
+        key for key in tasks if key[1] in selection or key[1] == "index-base.html"
+    ]
+    if ("pdf", "FCN") in tasks:
+        # FCN's packet joins every clinic packet, so those the last build
+        # didn't leave are built too.
+        wanted += [
+            ("pdf", clinic_name)
+            for clinic_name in pdf_clinics()
+            if not os.path.isfile(pdf_filename(clinic_name))
+        ]
+    kept = set()
+    while wanted:
+        key = wanted.pop()
+        if key not in kept:
+            kept.add(key)
+            wanted.extend(tasks[key][2])
+    return {key: task for key, task in tasks.items() if key in kept}
+
+
+def build_tasks():
+    """
+    Lists each entity's build tasks, keyed by (stage, name), with the tasks
+    they wait on and the tasks whose results they are passed. Dependencies on
+    stages that are switched off or entities left out of the selection are
+    dropped, but passed results can't be.
+    """
+    tasks = {}
+    if create_svgs:
+        # SVGs fill in their specs from the chart cache, so they only wait on
+        # the charts when those are built in the same run.
+        for name in sorted_single_provider_names:
+            tasks[("svgs", name)] = (save_individual_svgs, [("charts", name)], [])
+    if create_graphs:
+        for name in sorted_single_provider_names:
+            tasks[("charts", name)] = (save_individual_chart_data, [], [])
+        for clinic_name in clinics:
+            tasks[("charts", clinic_name)] = (save_clinic_chart_data, [], [])
+        tasks[("charts", "FCN")] = (save_fcn_chart_data, [], [])
+    if create_htmls:
+        all_individual_clinic_fcn = names[
+            (names["Type"].isin(["Individual", "Clinic", "FCN"]))
+        ].Name.unique()
+        for name in all_individual_clinic_fcn:
+            chart_data = [("charts", name)]
+            tasks[("html", name)] = (create_full_html, chart_data, chart_data)
+    tasks[("html", "index-base.html")] = (create_base_html, [], [])
+    if create_pdfs:
+        # One task per clinic, so its packet reuses its providers' pages.
+        for clinic_name in pdf_clinics():
+            providers = clinic_providers_for(clinic_name)
+            weasy_htmls = [("html", name) for name in providers]
+            tasks[("pdf", clinic_name)] = (
+                make_pdf,
+                weasy_htmls + [("svgs", name) for name in providers],
+                weasy_htmls,
+            )
+        if create_packets and pypdf_installed:
+            tasks[("pdf", "FCN")] = (
+                make_fcn_packet,
+                [("pdf", clinic_name) for clinic_name in pdf_clinics()],
+                [],
+            )
+        elif create_packets:
+            print("Skipping the FCN packet, it needs pypdf to join the clinics")
+
+    for key, (_, _, inputs) in tasks.items():
+        for dependency in inputs:
+            if dependency not in tasks:
+                raise ValueError(
+                    "{} needs {} built in the same run".format(key, dependency)
+                )
+    selection = selected_names()
+    if selection is not None:
+        tasks = selected_tasks(tasks, selection)
+    return {
+        key: (
+            function,
+            [dependency for dependency in dependencies if dependency in tasks],
+            inputs,
+        )
+        for key, (function, dependencies, inputs) in tasks.items()
+    }
+
+
+def task_cost(key):
+    """
+    Clinic and FCN charts grow with the number of bars they draw.
+    """
+    stage, name = key
+    if stage == "charts" and name in clinics:
+        return task_costs[stage] * len(clinic_providers_for(name))
+    if stage == "charts" and name == "FCN":
+        return task_costs[stage] * len(clinics)
+    if stage == "pdf" and name in pdf_clinics():
+        return task_costs[stage] * len(clinic_providers_for(name))
+    return task_costs[stage]
+
+
+def task_order(tasks, dependents):
+    """
+    Returns the task keys with every task after the tasks it waits on.
+    """
+    waiting = {key: len(dependencies) for key, (_, dependencies, _) in tasks.items()}
+    order = [key for key in tasks if not waiting[key]]
+    for key in order:
+        for dependent in dependents[key]:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                order.append(dependent)
+    return order
+
+
+def run_task(function, name, *inputs):
+    """
+    Runs one build task in a worker. Returns its payload for the tasks that
+    need it, and the task's timings with the worker's render and chart cache
+    stats for the task.
+    """
+    payload, seconds, cpu_seconds, start_mb, task_mb = timed_in_worker(
+        function, name, *inputs
+    )
+    stats = dict(collect_task_stats(), seconds=seconds, cpu_seconds=cpu_seconds)
+    return payload, dict(stats, worker_start_mb=start_mb, task_mb=task_mb)
+
+
+def payload_file(key):
+    return cache_folder + "payloads/" + hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def store_payload(key, payload):
+    """
+    Keeps a task's payload in memory, or spills it to disk once the payloads
+    waiting to be used pass the store's limit.
+    """
+    if payload_store["size"] + len(payload) <= payload_store["limit"]:
+        payload_store["memory"][key] = payload
+        payload_store["size"] += len(payload)
+    else:
+        write_cache_file(payload_file(key), payload)
+        payload_store["spilled"] += 1
+
+
+def load_payload(key):
+    if key in payload_store["memory"]:
+        return payload_store["memory"][key]
+    with open(payload_file(key), "r", encoding="utf-8") as payloadfile:
+        return payloadfile.read()
+
+
+def drop_payload(key):
+    if key in payload_store["memory"]:
+        payload_store["size"] -= len(payload_store["memory"].pop(key))
+    else:
+        os.remove(payload_file(key))
+
+
+def run_tasks(tasks):
+    """
+    Runs the build tasks on one pool, each as soon as the tasks it waits on
+    have finished, so one provider's PDF can start while another's charts
+    are still rendering. Only as many tasks as workers are handed out at a
+    time, so the longest chain of remaining work is always started next.
+    Payloads are held in the payload store until their last task has them.
+    Under a memory budget, the pool is sized so its idle workers fit, and a
+    task only starts while what it adds fits beside the running ones.
+    Each stage is timed from its first task starting to its last finishing.
+    Returns: dict of task key to the task's stats
+    """
+    reset_peak_rss()
+    dependents = {key: [] for key in tasks}
+    consumers = {key: 0 for key in tasks}
+    for key, (_, dependencies, inputs) in tasks.items():
+        for dependency in dependencies:
+            dependents[dependency].append(key)
+        for dependency in inputs:
+            consumers[dependency] += 1
+    chain_costs = {}
+    for key in reversed(task_order(tasks, dependents)):
+        chain_costs[key] = task_cost(key) + max(
+            [chain_costs[dependent] for dependent in dependents[key]], default=0
+        )
+
+    waiting = {key: set(dependencies) for key, (_, dependencies, _) in tasks.items()}
+    ready = [key for key in tasks if not waiting[key]]
+    finished = queue.Queue()
+    results = {}
+    processes = max_workers or os.cpu_count()
+    stage_task_mb = {stage: 0.0 for stage in task_costs}
+    task_room_mb = float("inf")
+    if memory_budget_mb is not None:
+        headroom_mb = max(0, memory_budget_mb - peak_rss_mb())
+        payload_store["limit"] = min(
+            payload_memory_limit, int(headroom_mb * 1024 * 1024 / 4)
+        )
+        headroom_mb -= payload_store["limit"] / 1024**2
+        stage_mb = {stage: stage_memory(stage) for stage in task_costs}
+        worker_mb = max(idle_mb for idle_mb, _ in stage_mb.values())
+        stage_task_mb = {stage: task_mb for stage, (_, task_mb) in stage_mb.items()}
+        processes = max(
+            1,
+            min(
+                processes,
+                int(headroom_mb // (worker_mb + min(stage_task_mb.values()))),
+            ),
+        )
+        task_room_mb = headroom_mb - processes * worker_mb
+    # Under a budget each worker is replaced after its task, so idle workers
+    # never hold on to what an earlier, hungrier task grew them to.
+    pool = multiprocessing.get_context(start_method).Pool(
+        processes,
+        initializer=start_worker,
+        initargs=(worker_state(),),
+        maxtasksperchild=None if memory_budget_mb is None else 1,
+    )
+    reserved_mb = 0.0
+    progress = tqdm.tqdm(total=len(tasks), desc="    Tasks")
+    running = 0
+    stage_spans = {}
+    while ready or running:
+        ready.sort(key=lambda key: chain_costs[key])
+        while ready and running < processes:
+            startable = [
+                key
+                for key in ready
+                if not running or reserved_mb + stage_task_mb[key[0]] <= task_room_mb
+            ]
+            if not startable:
+                break
+            key = startable[-1]
+            ready.remove(key)
+            function, _, inputs = tasks[key]
+            payloads = [load_payload(dependency) for dependency in inputs]
+            for dependency in inputs:
+                consumers[dependency] -= 1
+                if not consumers[dependency]:
+                    drop_payload(dependency)
+            pool.apply_async(
+                run_task,
+                (function, key[1], *payloads),
+                callback=lambda result, key=key: finished.put((key, result, None)),
+                error_callback=lambda error, key=key: finished.put((key, None, error)),
+            )
+            running += 1
+            reserved_mb += stage_task_mb[key[0]]
+            stage_spans.setdefault(key[0], [time.time(), None])
+        key, result, error = finished.get()
+        running -= 1
+        reserved_mb -= stage_task_mb[key[0]]
+        if error is not None:
+            pool.terminate()
+            raise error
+        payload, results[key] = result
+        stage_spans[key[0]][1] = time.time()
+        if key[0] == "html":
+            startup_seconds.setdefault(
+                "first_page", round(time.time() - build_start_time, 3)
+            )
+        if consumers[key]:
+            store_payload(key, payload)
+        progress.update()
+        for dependent in dependents[key]:
+            waiting[dependent].discard(key)
+            if not waiting[dependent]:
+                ready.append(dependent)
+    progress.close()
+    pool.close()
+    pool.join()
+    if payload_store["spilled"]:
+        print("Payloads: {} spilled to disk".format(payload_store["spilled"]))
+
+    for stage, (start_time, end_time) in stage_spans.items():
+        stage_results = {
+            key[1]: stats for key, stats in results.items() if key[0] == stage
+        }
+        stage_metric_seconds = {}
+        for stats in stage_results.values():
+            for metric, seconds in stats["metric_seconds"].items():
+                stage_metric_seconds[metric] = (
+                    stage_metric_seconds.get(metric, 0) + seconds
+                )
+        memory = {}
+        record_worker_memory(
+            memory,
+            [
+                (stats["worker_start_mb"], stats["task_mb"])
+                for stats in stage_results.values()
+            ],
+        )
+        record_stage(
+            stage,
+            end_time - start_time,
+            sum(stats["cpu_seconds"] for stats in stage_results.values()),
+            len(stage_results),
+            {name: stats["seconds"] for name, stats in stage_results.items()},
+            stage_metric_seconds,
+            memory["worker_start_mb"],
+            memory["task_mb"],
+        )
+    return results
+
+
+def copy_assets():
+    """
+    Copies the logo, scripts, styles and provider photos into ./docs.
+    """
+    with timed_stage("assets") as stage:
+        FCN_logo = "./files/pictures/logo.png"
+        if os.path.isfile(FCN_logo):
+            if not os.path.exists("./docs/pictures/"):
+                os.makedirs("./docs/pictures/")
+            shutil.copyfile(FCN_logo, "./docs/pictures/logo.png")
+            stage["items"] += 1
+
+        if not os.path.exists("./docs/js/"):
+            os.makedirs("./docs/js/")
+        files = glob.glob("./files/js/*.js")
+        for file in files:
+            _, tail = os.path.split(file)
+            shutil.copyfile(file, "./docs/js/" + str(tail))
+            stage["items"] += 1
+
+        css = "./files/uikit.min.css"
+        if os.path.isfile(css):
+            shutil.copyfile(css, "./docs/uikit.min.css")
+            stage["items"] += 1
+
+        favicon = "./files/pictures/favicon.ico"
+        if os.path.isfile(favicon):
+            shutil.copyfile(favicon, "./docs/favicon.ico")
+            stage["items"] += 1
+
+        comet_chart = "./files/pictures/quality_comet.png"
+        if os.path.isfile(comet_chart):
+            shutil.copyfile(comet_chart, "./docs/quality_comet.png")
+            stage["items"] += 1
+
+        for provider in sorted_single_provider_names:
+            provider_picture = (
+                "./files/pictures/" + str(provider).replace(" ", "_") + ".JPG"
+            )
+            if os.path.isfile(provider_picture):
+                shutil.copyfile(
+                    provider_picture,
+                    "./docs/pictures/" + str(provider).replace(" ", "_") + ".JPG",
+                )
+                stage["items"] += 1
+            else:
+                print("Missing photo:", provider_picture)
+
+
+def input_snapshot():
+    """
+    Returns the size and mtime of every export, lookup, template and asset.
+    """
+    return {
+        path: (os.stat(path).st_size, os.stat(path).st_mtime_ns)
+        for path in glob.glob("./data/*.csv") + glob.glob("./files/**", recursive=True)
+        if os.path.isfile(path)
+    }
+
+
+def entity_digests(report_df):
+    """
+    Hashes the rows of each provider, clinic and FCN, to find the entities
+    a changed export touches.
+    """
+    row_hashes = pd.util.hash_pandas_object(
+        report_df[["Metric", "Date", "%", "SeenNum", "SeenDenom"]], index=False
+    )
+    return {
+        name: hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+        for name, hashes in row_hashes.groupby(report_df["Name"], observed=True)
+    }
+
+
+def changed_entities(old_dataset, new_dataset):
+    """
+    Returns the providers, clinics and FCN whose rows differ between two
+    loads of the dataset.
+    """
+    old_digests = entity_digests(old_dataset)
+    new_digests = entity_digests(new_dataset)
+    return sorted(
+        name
+        for name in set(old_digests) | set(new_digests)
+        if old_digests.get(name) != new_digests.get(name)
+    )
+
+
+def affected_build(changed, old_dataset, new_dataset):
+    """
+    Returns the stages and entities to rebuild for a set of changed inputs,
+    None meaning all of them, and why. New or edited exports rebuild only the
+    entities that show the rows that changed, unless the current date moved
+    on, which every page shows. Template and asset edits rebuild pages and
+    PDFs from the chart cache without rendering SVGs again.
+    Returns: ((stages, entities) or None when nothing changed, reason)
+    """
+    if any(path.startswith("./data/") for path in changed):
+        if max(new_dataset["Date"]) != max(old_dataset["Date"]):
+            return (None, None), "new report date {}".format(
+                max(new_dataset["Date"]).strftime("%m/%d/%Y")
+            )
+        affected = changed_entities(old_dataset, new_dataset)
+        if not affected:
+            return None, "no rows changed"
+        reason = "changed rows for " + ", ".join(affected)
+        return (None, redrawn_entities(affected)), reason
+    stages = ["charts", "html", "pdf", "packets"]
+    if set(changed) & set(svg_renderer_files()):
+        stages.insert(1, "svgs")
+    return (stages, None), "edited " + ", ".join(changed)
+
+
+def watched_build_options(stages, entities):
+    """
+    Returns the options of a rebuild of the given stages and entities, None
+    meaning all of them, kept to the stages, providers, clinics and metrics
+    this watcher was started with. None when nothing watched is left. When
+    only FCN is left, which can't be selected on its own, the watched
+    selection is rebuilt.
+    """
+    watched_stages = [
+        stage
+        for stage, watched in zip(
+            build_stages,
+            [create_graphs, create_svgs, create_htmls, create_pdfs, create_packets],
+        )
+        if watched
+    ]
+    stages = [stage for stage in stages or build_stages if stage in watched_stages]
+    if not stages:
+        return None
+    selection = selected_names()
+    if entities is None:
+        entities = selection
+    elif selection is not None:
+        entities = entities & selection
+    options = ["--stages"] + stages
+    if entities is not None:
+        clinic_set = set(names[(names["Type"] == "Clinic")].Name)
+        providers = sorted(set(sorted_single_provider_names) & entities)
+        clinic_names = sorted(clinic_set & entities)
+        if not (providers or clinic_names):
+            providers, clinic_names = selected_providers, selected_clinics
+        options += ["--providers"] + providers if providers else []
+        options += ["--clinics"] + clinic_names if clinic_names else []
+    options += ["--metrics"] + selected_metrics if selected_metrics else []
+    return options
+
+
+def run_build(options):
+    """
+    Runs a build in a fresh process, with the worker settings of this one.
+    Returns: its timing report
+    """
+    command = [sys.executable, os.path.abspath(__file__)] + options
+    if max_workers:
+        command += ["--workers", str(max_workers)]
+    if start_method:
+        command += ["--start-method", start_method]
+    if memory_budget_mb is not None:
+        command += ["--memory-budget", str(memory_budget_mb)]
+    subprocess.run(command, check=True)
+    with open(timing_report_file, "r", encoding="utf-8") as reportfile:
+        return json.load(reportfile)
+
+
+def print_rebuild_summary(reason, report):
+    stage_items = {stage["stage"]: stage["items"] for stage in report["stages"]}
+    print(
+        "Rebuilt for {}: {} chart sets, {} SVG sets, {} pages, {} PDF tasks "
+        "in {:.1f}s".format(
+            reason,
+            stage_items.get("charts", 0),
+            stage_items.get("svgs", 0),
+            stage_items.get("html", 0),
+            stage_items.get("pdf", 0),
+            report["wall_seconds"],
+        )
+    )
+
+
+def watch():
+    """
+    Rebuilds what changes in ./data and ./files until interrupted, once the
+    changes have been quiet for watch_quiet_seconds. Rebuilds keep to the
+    stages and selection the watcher was started with. A changed names.csv
+    or metrics.csv remaps every export, so everything watched is rebuilt and
+    the watcher restarts to read the new lookups.
+    """
+    print("Watching ./data and ./files for changes, Ctrl-C to stop")
+    snapshot = input_snapshot()
+    dataset = load_dataset()
+    while True:
+        time.sleep(watch_interval)
+        current = input_snapshot()
+        if current == snapshot:
+            continue
+        quiet_since = time.time()
+        while time.time() - quiet_since < watch_quiet_seconds:
+            time.sleep(watch_interval)
+            latest = input_snapshot()
+            if latest != current:
+                current, quiet_since = latest, time.time()
+        changed = sorted(
+            path
+            for path in set(snapshot) | set(current)
+            if snapshot.get(path) != current.get(path)
+        )
+        snapshot = current
+
+        if set(changed) & set(["./files/names.csv", "./files/metrics.csv"]):
+            print_rebuild_summary(
+                "edited lookups", run_build(watched_build_options(None, None))
+            )
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        load_dataset.cache_clear()
+        new_dataset = load_dataset()
+        build, reason = affected_build(changed, dataset, new_dataset)
+        dataset = new_dataset
+        if build is None:
+            print("Nothing to rebuild, " + reason)
+            continue
+        options = watched_build_options(*build)
+        if options is None:
+            print("Nothing watched to rebuild for " + reason)
+            continue
+        try:
+            print_rebuild_summary(reason, run_build(options))
+        except subprocess.CalledProcessError as error:
+            print("Rebuild failed for {}: {}".format(reason, error))
+
+
+preview_cache = {
+    "responses": collections.OrderedDict(),
+    "size": 0,
+    "snapshot": None,
+    "dataset": None,
+}
+
+
+def read_custom_javascript():
+    with open("./files/js/jkp_custom.js", "r") as customjs:
+        return customjs.read()
+
+
+def preview_static_file(path):
+    """
+    Returns the file in ./files that copy_assets puts at path in ./docs.
+    """
+    if path.startswith("/js/") or path.startswith("/pictures/"):
+        return "./files" + path
+    return {
+        "/uikit.min.css": "./files/uikit.min.css",
+        "/favicon.ico": "./files/pictures/favicon.ico",
+        "/quality_comet.png": "./files/pictures/quality_comet.png",
+    }.get(path)
+
+
+def entities_by_folder():
+    """
+    Returns the name of every provider, clinic and FCN by its folder name.
+    """
+    return {
+        str(name).replace(" ", "_"): name
+        for name in names[
+            (names["Type"].isin(["Individual", "Clinic", "FCN"]))
+        ].Name.unique()
+    }
+
+
+def preview_chart_data(name):
+    entity_type = names[names.Name == name].iloc[0].Type
+    if entity_type == "Individual":
+        return save_individual_chart_data(name)
+    if entity_type == "Clinic":
+        return clinic_chart_data(name)
+    return fcn_chart_data(name)
+
+
+def preview_pdf(name):
+    """
+    Lays out a provider's PDF or a clinic's packet in memory, with the
+    charts read from the chart cache. FCN's packet joins the clinic packets.
+    """
+    if name not in sorted_single_provider_names and name not in pdf_clinics():
+        import pypdf
+
+        writer = pypdf.PdfWriter()
+        for clinic_name in pdf_clinics():
+            folder = str(clinic_name).replace(" ", "_")
+            _, _, body = preview_response("/{}/{}.pdf".format(folder, clinic_name))
+            writer.append(io.BytesIO(body))
+        packet = io.BytesIO()
+        writer.write(packet)
+        return packet.getvalue()
+    if name in sorted_single_provider_names:
+        providers = [name]
+    else:
+        providers = clinic_providers_for(name)
+    documents = []
+    for provider in providers:
+        documents.append(render_pdf(provider, weasy_html(provider)))
+    pages = [page for document in documents for page in document.pages]
+    return documents[0].copy(pages).write_pdf()
+
+
+def render_preview(path):
+    """
+    Renders one path of the site as the build would write it to ./docs.
+    Returns: (entity name or None, content type, body), or None when the
+    build wouldn't write the path
+    """
+    if path in ["/", "/index.html"]:
+        page = page_templates["index-base.html"].render(**base_html_context())
+        return None, "text/html; charset=utf-8", page.encode("utf-8")
+    static_file = preview_static_file(path)
+    if static_file is not None:
+        if not os.path.isfile(static_file):
+            return None
+        content_type = mimetypes.guess_type(static_file)[0]
+        return (
+            None,
+            content_type or "application/octet-stream",
+            read_resource(static_file),
+        )
+    folder, _, filename = path[1:].partition("/")
+    name = entities_by_folder().get(folder)
+    if name is None:
+        return None
+    if filename in ["", "index.html"]:
+        page = page_templates["index.html"].render(
+            **full_html_context(name, preview_chart_data(name))
+        )
+        return name, "text/html; charset=utf-8", page.encode("utf-8")
+    if filename == "datasets.js" and name not in sorted_single_provider_names:
+        script = shared_datasets_script(name)
+        return name, "application/javascript", script.encode("utf-8")
+    if filename == name + ".pdf" and (
+        name in sorted_single_provider_names
+        or name in pdf_clinics()
+        or (name == "FCN" and pypdf_installed)
+    ):
+        return name, "application/pdf", preview_pdf(name)
+    metric = filename[:-4]
+    if name in sorted_single_provider_names and filename == metric + ".svg":
+        if metric not in main_metrics:
+            return None
+        clinic_name = names[names.Name == name].iloc[0].Clinic
+        svg_file = cached_svg_file(
+            "Individual", individual_metric_data(metric, name, clinic_name)
+        )
+        with open(svg_file, "rb") as svgfile:
+            return name, "image/svg+xml", svgfile.read()
+    return None
+
+
+def preview_response(path):
+    """
+    Returns the response for a path from the preview cache, rendering it on
+    first request.
+    """
+    responses = preview_cache["responses"]
+    if path in responses:
+        responses.move_to_end(path)
+        return responses[path]
+    response = render_preview(path)
+    if response is None:
+        return None
+    responses[path] = response
+    preview_cache["size"] += len(response[2])
+    while preview_cache["size"] > preview_cache_limit and len(responses) > 1:
+        _, (_, _, body) = responses.popitem(last=False)
+        preview_cache["size"] -= len(body)
+    return response
+
+
+def drop_preview_responses(keep):
+    for path, response in list(preview_cache["responses"].items()):
+        if not keep(path, response[0]):
+            del preview_cache["responses"][path]
+            preview_cache["size"] -= len(response[2])
+
+
+def refresh_preview():
+    """
+    Drops the cached responses whose inputs changed since the last request.
+    Changed exports reload the dataset and drop the entities that show the
+    rows that changed, or everything when the report date moved on or FCN's
+    rows changed. Template and asset edits keep only SVGs and clinic datasets,
+    and a stylesheet edit has the PDF stylesheet parsed again.
+    A changed names.csv or metrics.csv restarts the server.
+    """
+    global page_templates, custom_javascript
+    current = input_snapshot()
+    snapshot = preview_cache["snapshot"]
+    preview_cache["snapshot"] = current
+    if current == snapshot:
+        return
+    changed = sorted(
+        path
+        for path in set(snapshot) | set(current)
+        if snapshot.get(path) != current.get(path)
+    )
+    if set(changed) & set(["./files/names.csv", "./files/metrics.csv"]):
+        print("Lookups changed, restarting the preview server")
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    read_resource.cache_clear()
+    if any(path.startswith("./data/") for path in changed):
+        load_dataset.cache_clear()
+        old_dataset, new_dataset = preview_cache["dataset"], load_dataset()
+        preview_cache["dataset"] = new_dataset
+        prepare_build()
+        get_series.cache_clear()
+        shared_series_rows.cache_clear()
+        shared_series_digest.cache_clear()
+        affected = changed_entities(old_dataset, new_dataset)
+        if max(new_dataset["Date"]) != max(old_dataset["Date"]):
+            drop_preview_responses(lambda path, name: False)
+        elif affected:
+            redrawn = redrawn_entities(affected)
+            drop_preview_responses(
+                lambda path, name: redrawn is not None and name not in redrawn
+            )
+        changed = [path for path in changed if not path.startswith("./data/")]
+    if changed:
+        page_templates = load_page_templates()
+        custom_javascript = read_custom_javascript()
+        if any(path.endswith(".css") for path in changed):
+            pdf_engine["font_config"] = None
+        svg_renderer_changed = bool(set(changed) & set(svg_renderer_files()))
+        if svg_renderer_changed:
+            svg_renderer_fingerprint.cache_clear()
+            stop_svg_driver()
+            svg_renderer["backend"] = None
+        drop_preview_responses(
+            lambda path, name: path.endswith("/datasets.js")
+            or (path.endswith(".svg") and not svg_renderer_changed)
+        )
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers each GET from the preview cache, after dropping what changed.
+    """
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+        if ".." in path.split("/"):
+            self.send_error(404)
+            return
+        if path[1:] in entities_by_folder():
+            self.send_response(301)
+            self.send_header("Location", path + "/")
+            self.end_headers()
+            return
+        refresh_preview()
+        try:
+            response = preview_response(path)
+        except Exception as error:
+            self.send_error(500, explain=repr(error))
+            raise
+        if response is None:
+            self.send_error(404)
+            return
+        _, content_type, body = response
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port):
+    """
+    Serves the site at localhost:port without building ./docs, rendering
+    each page, chart script, SVG and PDF on first request.
+    """
+    preview_cache["snapshot"] = input_snapshot()
+    preview_cache["dataset"] = load_dataset()
+    server = http.server.HTTPServer(("localhost", port), PreviewHandler)
+    print("Previewing at http://localhost:{}/, Ctrl-C to stop".format(port))
+    server.serve_forever()
+
+
+def main():
+    """
+    Builds the site in ./docs with the stages and entities given on the
+    command line, keeps rebuilding it in watch mode, or previews it.
+    """
+    global page_templates, custom_javascript
+    arguments = parse_arguments()
+    apply_arguments(arguments)
+    if arguments.watch:
+        watch()
+        return
+    prepare_build()
+    check_selection()
+    # Preview requests fill in any spec that isn't in the chart cache.
+    if create_graphs or create_svgs or run_benchmarks or arguments.serve is not None:
+        prepare_chart_templates()
+    if run_benchmarks:
+        benchmark_startup()
+        benchmark_charts()
+        benchmark_serialization()
+    page_templates = load_page_templates()
+    custom_javascript = read_custom_javascript()
+    if arguments.serve is not None:
+        serve(arguments.serve)
+        return
+    copy_assets()
+
+    task_stats = list(run_tasks(build_tasks()).values())
+    report_svg_stats(task_stats)
+    report_pdf_stats(task_stats)
+    if create_graphs or create_svgs:
+        with timed_stage("cleanup") as stage:
+            report_chart_cache(task_stats)
+            stage["items"] = len(glob.glob(cache_folder + "charts/*"))
+
+    print(
+        "Memory: main {:.0f} MB, workers up to {:.0f} MB as a task starts, "
+        "tasks adding up to {:.0f} MB{}".format(
+            lifetime_peak_rss_mb(),
+            worker_memory["start_mb"],
+            worker_memory["task_mb"],
+            ", budget {} MB".format(memory_budget_mb) if memory_budget_mb else "",
+        )
+    )
+    write_timing_report()
 
 
-# Remove all the temporary files now
-for file in glob.iglob("./docs/**/*.json", recursive=True):
-    os.remove(file)
-for file in glob.iglob("./docs/**/index-weasy.html", recursive=True):
-    os.remove(file)
+if __name__ == "__main__":
+    main()